@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+'''
+exdm – The Extensible X Display Manager
+
+Copyright © 2015  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Simulation harness for the exdm seat lifecycle
+#
+# Every seat is a process that goes through the same steps as
+# __main__.py: get_virtual_terminal, get_display, fork_exec_xserver,
+# waiting for readiness, and stop_server and remove_authentication_file.
+# X, xauth, fgconsole and hostname are replaced by the stand-ins in
+# stubs/, and RUNDIR and TMPDIR by a temporary directory, so nothing
+# outside of it is touched and no display hardware or root is needed.
+# A seat whose X server fails is respawned, like exdm would be.
+# Failures other than the injected ones fail the run.
+
+import os, sys, json, time, signal, shutil, argparse, tempfile
+
+SIMDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(SIMDIR), 'src'))
+
+import xauth, misc, xserver, util, metrics
+
+
+INJECTED_FAILURE = 3
+'''
+:int  The exit status of the stub X server on an injected failure
+'''
+
+DISPLAY_COLLISION = 1
+'''
+:int  The exit status of the stub X server when the display is already in use
+'''
+
+
+class CommandLine:
+    '''
+    Stand-in for the ArgParser that the lifecycle functions read
+    
+    @variable  files:list<str>                 The operands
+    @variable  opts:dict<str, list<str>|None>  The options
+    '''
+    
+    def __init__(self, files : list, x_arguments : list):
+        '''
+        Constructor
+        
+        @param  files:list<str>        The operands
+        @param  x_arguments:list<str>  Arguments for the X server
+        '''
+        self.files = files
+        self.opts = {'--x-argument' : x_arguments, '--configurations' : None}
+
+
+def count_fds() -> int:
+    '''
+    Count the process's open file descriptors
+    
+    @return  :int  The number of open file descriptors
+    '''
+    return len(os.listdir('/proc/self/fd'))
+
+
+def run_seat(seat : int, args, rundir : str, report : int):
+    '''
+    Run the lifecycles of one seat, this is called in a forked process
+    
+    @param  seat:int    The index of the seat
+    @param  args        The parsed command line
+    @param  rundir:str  The seat's RUNDIR
+    @param  report:int  File descriptor to write the results to, one JSON object per lifecycle
+    '''
+    xauth.RUNDIR = rundir
+    util.setenv('EXDM_SIM_VT', str(seat % 63 + 1))
+    cmdline = CommandLine([] if args.fgconsole else ['vt%i' % (seat % 63 + 1)], args.x_argument)
+    misc.get_virtual_terminal(cmdline)
+    fds = count_fds()
+    cycles, crashes = 0, 0
+    while cycles < args.cycles:
+        util.setenv('EXDM_SIM_SEED', '%s:%i:%i:%i' % (args.seed, seat, cycles, crashes))
+        started = time.monotonic()
+        result = {'seat' : seat, 'ok' : False}
+        if xauth.get_display() is None:
+            result['error'] = 'display'
+        else:
+            result['display'] = time.monotonic() - started
+            started = time.monotonic()
+            server_pid = xserver.fork_exec_xserver(cmdline)
+            ready = xserver.wait_for_server(server_pid, args.timeout)
+            if ready:
+                result['ok'] = True
+                result['latency'] = time.monotonic() - started
+                time.sleep(args.hold)
+            timed_out = (not ready) and os.waitid(os.P_PID, server_pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None
+            stopped = time.monotonic()
+            status = xserver.stop_server(server_pid)
+            result['stop'] = time.monotonic() - stopped
+            if timed_out:
+                result['error'] = 'timeout'
+            elif not ready:
+                status = None if status is None else os.waitstatus_to_exitcode(status)
+                result['error'] = {INJECTED_FAILURE : 'injected', DISPLAY_COLLISION : 'collision'}.get(status, 'crash')
+        if result['ok']:
+            cycles += 1
+            xauth.remove_authentication_file()
+            result['fds'] = count_fds() - fds
+        else:
+            # Failed: leave the authentication files for the respawn to find
+            crashes += 1
+        os.write(report, (json.dumps(result) + '\n').encode('utf-8'))
+        if crashes > args.max_crashes:
+            break
+    xauth.remove_authentication_file()
+    os.write(report, (json.dumps({'seat' : seat, 'respawns' : sum(metrics.RESPAWNS.values.values())}) + '\n').encode('utf-8'))
+
+
+def percentile(values : list, p : float) -> float:
+    '''
+    Get a percentile of a list of values
+    
+    @param   values:list<float>  The values, sorted
+    @param   p:float             The percentile, 0–100
+    @return  :float              The value at the percentile, 0 if there are no values
+    '''
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Load test the exdm seat lifecycle against stand-ins')
+    parser.add_argument('--seats',       type = int,   default = 100,  help = 'number of concurrent seats')
+    parser.add_argument('--cycles',      type = int,   default = 3,    help = 'successful lifecycles per seat')
+    parser.add_argument('--hold',        type = float, default = 0,    help = 'seconds each X server is kept running')
+    parser.add_argument('--timeout',     type = float, default = 30,   help = 'seconds to wait for readiness')
+    parser.add_argument('--max-crashes', type = int,   default = 20,   help = 'failures after which a seat gives up')
+    parser.add_argument('--x-delay',     type = float, default = 0.05, help = 'seconds until the stub X server is ready')
+    parser.add_argument('--x-jitter',    type = float, default = 0.05, help = 'random extra readiness delay, in seconds')
+    parser.add_argument('--x-fail',      type = float, default = 0,    help = 'probability that X fails before readiness')
+    parser.add_argument('--x-hang',      type = float, default = 0,    help = 'probability that X ignores SIGTERM')
+    parser.add_argument('--x-argument',  action = 'append', default = [], help = 'argument for the X server')
+    parser.add_argument('--fgconsole',   action = 'store_true',  help = 'select the VT with fgconsole instead of vt$N')
+    parser.add_argument('--seed',        default = '0',   help = 'seed for the failure injection')
+    parser.add_argument('--keep',        action = 'store_true',  help = 'keep the temporary directory')
+    args = parser.parse_args()
+    if args.seats > 256:
+        print('%s: at most 256 seats fit in the display space' % sys.argv[0], file = sys.stderr)
+        sys.exit(1)
+    
+    tmpdir = tempfile.mkdtemp(prefix = 'exdm-sim.')
+    xauth.TMPDIR = tmpdir
+    # Every seat has its own RUNDIR, but the displays must be reserved in a shared directory
+    xauth.RESERVATION_DIR = tmpdir
+    util.setenv('PATH', os.path.join(SIMDIR, 'stubs') + ':' + os.environ['PATH'])
+    util.setenv('EXDM_SIM_TMPDIR', tmpdir)
+    util.setenv('EXDM_SIM_PIDLOG', os.path.join(tmpdir, 'xpids'))
+    util.setenv('EXDM_SIM_X_DELAY', str(args.x_delay))
+    util.setenv('EXDM_SIM_X_JITTER', str(args.x_jitter))
+    util.setenv('EXDM_SIM_X_FAIL', str(args.x_fail))
+    util.setenv('EXDM_SIM_X_HANG', str(args.x_hang))
+    xserver.XSERVER_STOP_TIMEOUT = 1
+    
+    (rfd, wfd) = os.pipe()
+    started = time.monotonic()
+    seats = {}
+    for seat in range(args.seats):
+        rundir = os.path.join(tmpdir, 'seat%i' % seat)
+        os.mkdir(rundir)
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            # Keep the output readable, the seats would otherwise print a line per step
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+            status = 0
+            try:
+                run_seat(seat, args, rundir, wfd)
+            except BaseException as err:
+                os.write(wfd, (json.dumps({'seat' : seat, 'exception' : repr(err)}) + '\n').encode('utf-8'))
+                status = 1
+            os._exit(status)
+        seats[pid] = rundir
+    os.close(wfd)
+    with os.fdopen(rfd, 'rb') as file:
+        results = [json.loads(line) for line in file]
+    for pid in seats:
+        os.waitpid(pid, 0)
+    elapsed = time.monotonic() - started
+    
+    # Look for anything the lifecycles left behind
+    leaked_pids = []
+    try:
+        with open(os.path.join(tmpdir, 'xpids'), 'r') as file:
+            for pid in [int(line) for line in file if line.strip()]:
+                try:
+                    with open('/proc/%i/stat' % pid, 'r') as stat:
+                        if not stat.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                            leaked_pids.append(pid)
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+    leaked_auth = [os.path.join(d, f) for d in seats.values() for f in os.listdir(d) if '.auth' in f]
+    # Locks left by X servers that had to be killed are stale, not leaked,
+    # the next X server on the display replaces them, as Xorg does
+    locks = [int(f[2:-5]) for f in os.listdir(tmpdir) if f.startswith('.X') and f.endswith('-lock')]
+    leaked_locks = [d for d in locks if xauth.is_display_in_use(d)]
+    leaked_reservations = [f for f in os.listdir(tmpdir) if f.startswith('%s.display' % xauth.PKGNAME)]
+    
+    ok = [r for r in results if r.get('ok', False)]
+    failed = [r for r in results if ('error' in r)]
+    uninjected = [r for r in failed if not r['error'] == 'injected']
+    exceptions = [r for r in results if 'exception' in r]
+    latencies = sorted(r['latency'] for r in ok)
+    selections = sorted(r['display'] for r in results if 'display' in r)
+    stops = sorted(r['stop'] for r in results if 'stop' in r)
+    print('seats:             %i' % args.seats)
+    print('lifecycles:        %i in %.2f s, %.1f seats/s' % (len(ok), elapsed, len(ok) / elapsed))
+    print('failures:          %i (%s)' % (len(failed), ', '.join('%s: %i' % (e, sum(1 for r in failed if r['error'] == e))
+                                                                  for e in sorted(set(r['error'] for r in failed)))))
+    print('uninjected:        %i' % len(uninjected))
+    print('respawns:          %i' % sum(r.get('respawns', 0) for r in results))
+    print('seat exceptions:   %i' % len(exceptions))
+    for r in exceptions[:5]:
+        print('    seat %i: %s' % (r['seat'], r['exception']))
+    print('display selection: p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms'
+          % tuple(1000 * percentile(selections, p) for p in (50, 90, 99, 100)))
+    print('readiness latency: p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms'
+          % tuple(1000 * percentile(latencies, p) for p in (50, 90, 99, 100)))
+    print('stop duration:     p50 %.1f ms, p99 %.1f ms, max %.1f ms'
+          % tuple(1000 * percentile(stops, p) for p in (50, 99, 100)))
+    print('leaked fds:        %i' % sum(r.get('fds', 0) for r in ok))
+    print('leaked pids:       %i%s' % (len(leaked_pids), '' if not leaked_pids else ' ' + repr(leaked_pids[:10])))
+    print('leaked auth files: %i' % len(leaked_auth))
+    print('leaked X locks:    %i (%i stale)' % (len(leaked_locks), len(locks) - len(leaked_locks)))
+    print('leaked displays:   %i' % len(leaked_reservations))
+    
+    for pid in leaked_pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    if args.keep:
+        print('kept:              %s' % tmpdir)
+    else:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+    leaks = len(leaked_pids) + len(leaked_auth) + len(leaked_locks) + len(leaked_reservations)
+    leaks += sum(r.get('fds', 0) for r in ok)
+    sys.exit(1 if (leaks or exceptions or uninjected) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,9 @@ from argparser import *
 
 from util import *
 from misc import *
+from config import *
+from metrics import *
+from xdmcp import *
 from xauth import *
 from xserver import *
 
@@ -53,6 +56,7 @@ parser = ArgParser('The Extensible X Display Manager',
 
 parser.add_argumented(  ['-c', '--configurations'],         0, 'FILE', 'Select configuration file')
 parser.add_argumented(  ['-x', '--x-argument'],             0, 'ARG',  'Pass an argument on to the X server')
+parser.add_argumentless(['-q', '--xdmcp'],                  0,         'Manage remote X terminals over XDMCP')
 parser.add_argumentless(['-h', '-?', '--help'],             0,         'Print this help information')
 parser.add_argumentless(['-C', '--copying', '--copyright'], 0,         'Print copyright information')
 parser.add_argumentless(['-W', '--warranty'],               0,         'Print non-warranty information')
@@ -80,30 +84,48 @@ elif parser.opts['--version'] is not None:
 # Check that the user is root
 check_root_uid()
 
+# Load configurations
+if parser.opts['--configurations'] is not None:
+    conf = load_configuration(parser.opts['--configurations'][0])
+    if conf is None:
+        sys.exit(1)
+    apply_configuration(conf)
+
 # Configure signal
-configure_signals(lambda sig, frame : sys.exit(1)) # TODO stop server
+configure_signals(lambda sig, frame : terminate(1),
+                  None if get_configuration() is None else lambda sig, frame : reload_configuration())
 
 # Set environment
 set_environment_from_cmdline(parser)
 
+# Manage remote X terminals instead of a local X server
+if parser.opts['--xdmcp'] is not None:
+    serve_xdmcp()
+
 # Get virtual terminal
 get_virtual_terminal(parser)
 
+# Start serving metrics
+serve_metrics()
+
 # Get display
 if get_display() is None:
-    sys.exit(1)
+    terminate(1)
 
 
 
-# [X is running] ||
+# Start X server and wait until it is ready
 server_pid = fork_exec_xserver(parser)
-if timedwaitpid(server_pid, 0) is None:
-    if not connect(): # TODO
-        stop_server() # TODO
+status = 1
+try:
+    if not wait_for_server(server_pid):
         print('%s: unable to connect to X server' % sys.argv[0], file = sys.stderr)
-        sys.exit(1)
-
-
-# Remove server authentication
-remove_authentication_file()
+        terminate(1)
+    
+    # TODO start the greeter, until then keep the display until the X server exits
+    os.waitid(os.P_PID, server_pid, os.WEXITED | os.WNOWAIT)
+    status = 0
+finally:
+    # Stop server and remove server authentication
+    terminate(status)
 
@@ -0,0 +1,339 @@
+# -*- python -*-
+'''
+exdm – The Extensible X Display Manager
+
+Copyright © 2015  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import bisect
+
+from issue import SYSCONFDIR
+from xauth import PKGNAME
+
+
+CACHEDIR = '/var/cache' # @@
+'''
+:str  The installed system's path for /var/cache
+'''
+
+LOCALE_DIR = '/usr/lib/locale' # @@
+'''
+:str  The directory where compiled locales are installed
+'''
+
+LOCALE_ALIAS_FILES = ('/usr/share/locale/locale.alias', SYSCONFDIR + '/locale.alias') # @@
+'''
+:tuple<str>  The files where locale aliases may be defined
+'''
+
+XKB_RULES_FILE = '/usr/share/X11/xkb/rules/evdev.xml' # @@
+'''
+:str  The XKB rules file listing keyboard layouts and their variants
+'''
+
+CATALOGUE_CACHE = '%s/%s/catalogue' % (CACHEDIR, PKGNAME)
+'''
+:str  The pathname of the compiled catalogue
+'''
+
+CACHE_VERSION = 1
+'''
+:int  The version of the format of the compiled catalogue,
+      cached catalogues of any other version are ignored
+'''
+
+LOCALE_ARCHIVE_MAGIC = 0xde020109
+'''
+:int  The magic number of glibc's locale-archive
+'''
+
+
+
+class Catalogue:
+    '''
+    Locales and keyboard layouts available for the greeter to offer
+    
+    The lists are sorted by their case-folded names, so that
+    prefix searches are binary searches
+    
+    @variable  locales:list<str>                                      The installed locales
+    @variable  aliases:dict<str, str>                                 Locale alias → locale
+    @variable  layouts:list<(name:str, description:str)>              The keyboard layouts
+    @variable  variants:dict<str, list<(name:str, description:str)>>  Layout → its variants
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.locales  = []
+        self.aliases  = {}
+        self.layouts  = []
+        self.variants = {}
+        self.__locale_keys = None
+        self.__layout_keys = None
+    
+    
+    def dump(self) -> tuple:
+        '''
+        Get the catalogue as a marshallable value
+        
+        @return  :tuple  The catalogue's content
+        '''
+        return (self.locales, self.aliases, self.layouts, self.variants)
+    
+    
+    @staticmethod
+    def undump(data : tuple):
+        '''
+        Reconstruct a catalogue from `dump`'s return value
+        
+        @param   data:tuple  The catalogue's content
+        @return  :Catalogue  The catalogue
+        '''
+        catalogue = Catalogue()
+        (catalogue.locales, catalogue.aliases, layouts, variants) = data
+        catalogue.layouts = [tuple(layout) for layout in layouts]
+        catalogue.variants = dict((k, [tuple(v) for v in vs]) for k, vs in variants.items())
+        return catalogue
+    
+    
+    def search_locales(self, prefix : str = '') -> list:
+        '''
+        Find locales by case-insensitive prefix
+        
+        @param   prefix:str  The beginning of the locales' names
+        @return  :list<str>  The matching locales
+        '''
+        if self.__locale_keys is None:
+            self.__locale_keys = [locale.casefold() for locale in self.locales]
+        return [self.locales[i] for i in prefix_range(self.__locale_keys, prefix.casefold())]
+    
+    
+    def search_layouts(self, prefix : str = '') -> list:
+        '''
+        Find keyboard layouts by case-insensitive prefix of their names
+        
+        @param   prefix:str                          The beginning of the layouts' names
+        @return  :list<(name:str, description:str)>  The matching layouts
+        '''
+        if self.__layout_keys is None:
+            self.__layout_keys = [name.casefold() for (name, _) in self.layouts]
+        return [self.layouts[i] for i in prefix_range(self.__layout_keys, prefix.casefold())]
+    
+    
+    def resolve_locale(self, name : str) -> str:
+        '''
+        Resolve a locale alias
+        
+        @param   name:str  The name of the locale, or an alias
+        @return  :str?     The locale, `None` if it is not installed
+        '''
+        name = self.aliases.get(name, name)
+        if name in self.locales:
+            return name
+        # glibc normalises the codeset, 'en_US.UTF-8' is installed as 'en_US.utf8'
+        if '.' in name:
+            (base, codeset) = name.split('.', 1)
+            modifier = ''
+            if '@' in codeset:
+                (codeset, modifier) = codeset.split('@', 1)
+                modifier = '@' + modifier
+            normalised = '%s.%s%s' % (base, ''.join(c for c in codeset.lower() if c.isalnum()), modifier)
+            if normalised in self.locales:
+                return normalised
+        return None
+
+
+def prefix_range(keys : list, prefix : str) -> range:
+    '''
+    Find the elements in a sorted list that start with a prefix
+    
+    @param   keys:list<str>  The sorted list
+    @param   prefix:str      The prefix
+    @return  :range          The indices of the matching elements
+    '''
+    start = bisect.bisect_left(keys, prefix)
+    end = start
+    while (end < len(keys)) and keys[end].startswith(prefix):
+        end += 1
+    return range(start, end)
+
+
+def read_locale_archive(pathname : str) -> list:
+    '''
+    List the locales in glibc's locale-archive
+    
+    @param   pathname:str  The pathname of the locale-archive
+    @return  :list<str>    The names of the locales in the archive
+    '''
+    import mmap, struct
+    # The archive is typically hundreds of megabytes, only touch the pages we need
+    with open(pathname, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        (magic, _serial, hash_offset, _hash_used, hash_size) = struct.unpack_from('=5I', data, 0)
+        if not magic == LOCALE_ARCHIVE_MAGIC:
+            return []
+        locales = []
+        for i in range(hash_size):
+            (_hashval, name_offset, _locrec_offset) = struct.unpack_from('=3I', data, hash_offset + 12 * i)
+            if name_offset == 0:
+                continue
+            end = data.find(b'\0', name_offset)
+            locales.append(data[name_offset : end].decode('utf-8', 'replace'))
+        return locales
+    finally:
+        data.close()
+
+
+def read_locale_aliases(pathname : str) -> dict:
+    '''
+    Read a locale.alias file
+    
+    @param   pathname:str     The pathname of the file
+    @return  :dict<str, str>  Alias → locale
+    '''
+    aliases = {}
+    with open(pathname, 'rb') as file:
+        for line in file.read().decode('utf-8', 'replace').split('\n'):
+            line = line.split('#')[0].split()
+            if len(line) >= 2:
+                aliases[line[0]] = line[1]
+    return aliases
+
+
+def read_xkb_layouts(pathname : str) -> (list, dict):
+    '''
+    Read the keyboard layouts and their variants from an XKB rules file
+    
+    @param   pathname:str  The pathname of the XML rules file
+    @return  :(list<(name:str, description:str)>, dict<str, list<(name:str, description:str)>>)
+                           The layouts, and layout → its variants
+    '''
+    import xml.etree.ElementTree as ElementTree
+    layouts, variants = [], {}
+    def config_item(element):
+        item = element.find('configItem')
+        if item is None:
+            return None
+        return ((item.findtext('name') or '').strip(), (item.findtext('description') or '').strip())
+    # Elements are discarded as soon as they have been read,
+    # so the whole file never has to be kept in memory
+    for (_event, element) in ElementTree.iterparse(pathname, events = ('end',)):
+        if element.tag == 'layout':
+            layout = config_item(element)
+            if layout is not None:
+                layouts.append(layout)
+                variants[layout[0]] = []
+                for variant in element.iterfind('variantList/variant'):
+                    variant = config_item(variant)
+                    if variant is not None:
+                        variants[layout[0]].append(variant)
+                variants[layout[0]].sort(key = lambda v : v[0].casefold())
+            element.clear()
+        elif element.tag in ('model', 'group'):
+            element.clear()
+    layouts.sort(key = lambda l : l[0].casefold())
+    return (layouts, variants)
+
+
+def get_catalogue_sources() -> tuple:
+    '''
+    Identify the current versions of the catalogue's sources
+    
+    @return  :tuple  The pathname, modification time and size of each source, the
+                     modification time and size are `None` for missing sources
+    '''
+    sources = [LOCALE_DIR, LOCALE_DIR + '/locale-archive', XKB_RULES_FILE] + list(LOCALE_ALIAS_FILES)
+    def identify(pathname):
+        try:
+            st = os.stat(pathname)
+            return (pathname, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return (pathname, None, None)
+    return (CACHE_VERSION,) + tuple(identify(s) for s in sources)
+
+
+def build_catalogue() -> Catalogue:
+    '''
+    Build the catalogue by scanning its sources
+    
+    @return  :Catalogue  The catalogue
+    '''
+    import struct
+    catalogue = Catalogue()
+    locales = set()
+    try:
+        for name in os.listdir(LOCALE_DIR):
+            if os.path.exists('%s/%s/LC_CTYPE' % (LOCALE_DIR, name)):
+                locales.add(name)
+    except OSError:
+        pass
+    try:
+        locales.update(read_locale_archive(LOCALE_DIR + '/locale-archive'))
+    except (OSError, ValueError, struct.error):
+        pass
+    catalogue.locales = sorted(locales, key = str.casefold)
+    for pathname in LOCALE_ALIAS_FILES:
+        try:
+            catalogue.aliases.update(read_locale_aliases(pathname))
+        except OSError:
+            pass
+    try:
+        (catalogue.layouts, catalogue.variants) = read_xkb_layouts(XKB_RULES_FILE)
+    except (OSError, SyntaxError) as err:
+        print('%s: cannot read %s: %s' % (sys.argv[0], XKB_RULES_FILE, err), file = sys.stderr)
+    return catalogue
+
+
+def load_catalogue() -> Catalogue:
+    '''
+    Load the catalogue from the cache, rebuilding the cache
+    if any source has changed since it was written
+    
+    @return  :Catalogue  The catalogue
+    '''
+    import marshal
+    key = get_catalogue_sources()
+    try:
+        with open(CATALOGUE_CACHE, 'rb') as file:
+            (cached_key, data) = marshal.load(file)
+        if cached_key == key:
+            return Catalogue.undump(data)
+    except:
+        pass
+    catalogue = build_catalogue()
+    # Update the cache, failure is not fatal. Greeters on several seats may
+    # do this at the same time, so each writes its own file before renaming
+    import tempfile
+    tmpname = None
+    try:
+        os.makedirs(os.path.dirname(CATALOGUE_CACHE), mode = 0o755, exist_ok = True)
+        (fd, tmpname) = tempfile.mkstemp(dir = os.path.dirname(CATALOGUE_CACHE), prefix = '.catalogue.')
+        with os.fdopen(fd, 'wb') as file:
+            marshal.dump((key, catalogue.dump()), file)
+        os.chmod(tmpname, 0o644)
+        os.rename(tmpname, CATALOGUE_CACHE)
+    except:
+        if tmpname is not None:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+    return catalogue
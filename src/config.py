@@ -0,0 +1,292 @@
+# -*- python -*-
+'''
+exdm – The Extensible X Display Manager
+
+Copyright © 2015  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+
+
+CACHE_VERSION = 3
+'''
+:int  The version of the format of compiled configurations,
+      cached configurations of any other version are ignored
+'''
+
+MAX_STOP_TIMEOUT = 3600
+'''
+:float  The greatest allowed value of stop-timeout, in seconds
+'''
+
+
+class Configuration:
+    '''
+    Parsed and validated configuration file
+    
+    The configuration file consists of lines on the format `KEY = VALUE`,
+    empty lines and lines starting with `#` are ignored. The recognised keys are:
+    
+        env           `VARIABLE=VALUE`, may be used multiple times
+        vt            The virtual terminal to use if none is specified on the command line
+        x-argument    Argument to pass on to the X server, may be used multiple times
+        stop-timeout  The number of seconds the X server is given to terminate
+    
+    @variable  pathname:str                The pathname of the configuration file
+    @variable  environment:dict<str, str>  Environment variables to set
+    @variable  vt:int?                     The virtual terminal to use, `None` if unspecified
+    @variable  x_arguments:list<str>       Additional arguments for the X server
+    @variable  stop_timeout:float?         The number of seconds the X server is given to
+                                           terminate, `None` if unspecified
+    '''
+    
+    SETTINGS = ('environment', 'vt', 'x_arguments', 'stop_timeout')
+    '''
+    :tuple<str>  The names of the variables that hold settings
+    '''
+    
+    
+    def __init__(self, pathname : str):
+        '''
+        Constructor
+        
+        @param  pathname:str  The pathname of the configuration file
+        '''
+        self.pathname     = pathname
+        self.environment  = {}
+        self.vt           = None
+        self.x_arguments  = []
+        self.stop_timeout = None
+    
+    
+    @staticmethod
+    def parse(pathname : str, data : str):
+        '''
+        Parse a configuration file
+        
+        @param   pathname:str     The pathname of the configuration file, used in error messages
+        @param   data:str         The content of the configuration file
+        @return  :Configuration?  The configuration, `None` on error
+        '''
+        conf = Configuration(pathname)
+        for lineno, line in enumerate(data.split('\n')):
+            line = line.strip()
+            if (line == '') or line.startswith('#'):
+                continue
+            def error(message):
+                print('%s: %s:%i: %s' % (sys.argv[0], pathname, lineno + 1, message), file = sys.stderr)
+            if '=' not in line:
+                error('expected `KEY = VALUE`')
+                return None
+            key, value = [x.strip() for x in line.split('=', 1)]
+            if key == 'env':
+                if '=' not in value:
+                    error('expected `env = VARIABLE=VALUE`')
+                    return None
+                var, val = [x.strip() for x in value.split('=', 1)]
+                conf.environment[var] = val
+            elif key == 'vt':
+                try:
+                    conf.vt = int(value)
+                except:
+                    conf.vt = None
+                if (conf.vt is None) or not (0 < conf.vt < 64):
+                    error('invalid virtual terminal: %s' % value)
+                    return None
+            elif key == 'x-argument':
+                conf.x_arguments.append(value)
+            elif key == 'stop-timeout':
+                try:
+                    conf.stop_timeout = float(value)
+                except:
+                    conf.stop_timeout = -1
+                if not (0 <= conf.stop_timeout <= MAX_STOP_TIMEOUT):
+                    error('invalid timeout, must be between 0 and %i: %s' % (MAX_STOP_TIMEOUT, value))
+                    return None
+            else:
+                error('unrecognised key: %s' % key)
+                return None
+        return conf
+    
+    
+    def changes(self, old) -> list:
+        '''
+        Get the settings that differ from another configuration
+        
+        @param   old:Configuration?  The previous configuration, `None` if there was none
+        @return  :list<str>          The names of the variables whose values differ
+        '''
+        if old is None:
+            old = Configuration(self.pathname)
+        return [s for s in Configuration.SETTINGS if not getattr(self, s) == getattr(old, s)]
+
+
+def get_cache_pathname(pathname : str) -> str:
+    '''
+    Get the pathname of the compiled configuration cache
+    
+    @param   pathname:str  The pathname of the configuration file
+    @return  :str          The pathname of the cache file
+    '''
+    from xauth import RUNDIR, PKGNAME
+    return '%s/%s.%s.conf.cache' % (RUNDIR, PKGNAME, os.path.abspath(pathname).replace('/', '%'))
+
+
+def load_configuration(pathname : str) -> Configuration:
+    '''
+    Load a configuration file
+    
+    The compiled configuration is cached, keyed on the file's
+    device, inode, modification time and size, so that the file
+    does not have to be parsed again when exdm is respawned
+    
+    @param   pathname:str     The pathname of the configuration file
+    @return  :Configuration?  The configuration, `None` on error
+    '''
+    import marshal
+    try:
+        st = os.stat(pathname)
+    except OSError as err:
+        print('%s: %s: %s' % (sys.argv[0], pathname, err.strerror), file = sys.stderr)
+        return None
+    key = (CACHE_VERSION, os.path.abspath(pathname), st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+    cache = get_cache_pathname(pathname)
+    
+    # Try the cache
+    try:
+        with open(cache, 'rb') as file:
+            (cached_key, settings) = marshal.load(file)
+        if cached_key == key:
+            conf = Configuration(pathname)
+            for setting in Configuration.SETTINGS:
+                setattr(conf, setting, settings[setting])
+            return conf
+    except:
+        pass
+    
+    # Parse the file
+    try:
+        with open(pathname, 'rb') as file:
+            data = file.read().decode('utf-8', 'strict')
+    except OSError as err:
+        print('%s: %s: %s' % (sys.argv[0], pathname, err.strerror), file = sys.stderr)
+        return None
+    except UnicodeDecodeError:
+        print('%s: %s: not valid UTF-8' % (sys.argv[0], pathname), file = sys.stderr)
+        return None
+    conf = Configuration.parse(pathname, data)
+    if conf is None:
+        return None
+    
+    # Update the cache, failure is not fatal
+    settings = dict((setting, getattr(conf, setting)) for setting in Configuration.SETTINGS)
+    try:
+        with open(cache + '~', 'wb', opener = lambda p, f : os.open(p, f, mode = 0o600)) as file:
+            marshal.dump((key, settings), file)
+        os.rename(cache + '~', cache)
+    except:
+        pass
+    return conf
+
+
+__config_current = None
+def get_configuration() -> Configuration:
+    '''
+    Get the configuration currently in effect
+    
+    @return  :Configuration?  The configuration, `None` if none has been loaded
+    '''
+    return __config_current
+
+
+__config_inherited = {}
+'''
+:dict<str, str?>  Environment variable → its value before the configuration
+                  set it, `None` if it was unset
+'''
+
+__config_protected = set()
+'''
+:set<str>  Environment variables the configuration may not change
+'''
+
+
+def protect_environment(variables):
+    '''
+    Stop the configuration from changing environment variables,
+    this is used for variables set on the command line, which
+    take precedence over the configuration file
+    
+    @param  variables:itr<str>  The names of the variables
+    '''
+    __config_protected.update(variables)
+
+
+def apply_configuration(conf : Configuration):
+    '''
+    Put a configuration into effect, only settings that
+    have changed since the previous configuration are applied
+    
+    Settings that concern how the X server is started do not
+    affect running X servers, only X servers started later
+    
+    Environment variables that are removed from the configuration
+    are restored to the values they had before it set them
+    
+    @param  conf:Configuration  The configuration
+    '''
+    import xserver
+    from util import setenv
+    global __config_current
+    old, __config_current = __config_current, conf
+    changes = conf.changes(old)
+    if 'environment' in changes:
+        old_environment = {} if old is None else old.environment
+        for var in old_environment:
+            if (var not in conf.environment) and (var not in __config_protected):
+                val = __config_inherited.pop(var, None)
+                if (val is not None) or (var in os.environ):
+                    setenv(var, val)
+        for var, val in conf.environment.items():
+            if var in __config_protected:
+                continue
+            if var not in __config_inherited:
+                __config_inherited[var] = os.environ.get(var, None)
+            if not os.environ.get(var, None) == val:
+                setenv(var, val)
+    if 'stop_timeout' in changes:
+        if conf.stop_timeout is None:
+            xserver.XSERVER_STOP_TIMEOUT = xserver.DEFAULT_XSERVER_STOP_TIMEOUT
+        else:
+            xserver.XSERVER_STOP_TIMEOUT = conf.stop_timeout
+
+
+def reload_configuration() -> bool:
+    '''
+    Reload the configuration file and apply the settings that have changed
+    
+    @return  :bool  Whether the configuration was reloaded, the
+                    old configuration is kept in effect on failure
+    '''
+    if __config_current is None:
+        return False
+    conf = load_configuration(__config_current.pathname)
+    if conf is None:
+        print('%s: keeping old configuration' % sys.argv[0], file = sys.stderr)
+        return False
+    apply_configuration(conf)
+    return True
@@ -0,0 +1,256 @@
+# -*- python -*-
+'''
+exdm – The Extensible X Display Manager
+
+Copyright © 2015  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+
+
+BLANK = (' ', '')
+'''
+:(str, str)  An empty cell with default rendition
+'''
+
+
+class ConsoleRenderer:
+    '''
+    Damage-tracked renderer for the Linux console
+    
+    Drawing is done into a back buffer of cells, each cell being a
+    character and the SGR parameters it is rendered with. `flush`
+    compares it against what is known to be on the screen and writes
+    only the cells that differ, using as few cursor movements and SGR
+    changes as it can, in one `os.write`
+    
+    @variable  fd:int                          The file descriptor of the terminal
+    @variable  rows:int                        The height of the screen, in cells
+    @variable  columns:int                     The width of the screen, in cells
+    @variable  back:list<list<(str, str)>>     The cells that should be on the screen
+    @variable  front:list<list<(str, str)>>?   The cells that are on the screen, `None` if unknown
+    @variable  palette:list<(int, int, int)>?  Palette to set on the next flush, `None` if none
+    '''
+    
+    def __init__(self, fd : int):
+        '''
+        Constructor
+        
+        @param  fd:int  The file descriptor of the terminal
+        '''
+        self.fd = fd
+        self.palette = None
+        self.resize()
+    
+    
+    def resize(self):
+        '''
+        Read the size of the terminal and clear the buffer
+        
+        The next flush will repaint the whole screen
+        '''
+        try:
+            (self.columns, self.rows) = os.get_terminal_size(self.fd)
+        except OSError:
+            (self.columns, self.rows) = (80, 24)
+        self.front = None
+        self.clear()
+    
+    
+    def clear(self):
+        '''
+        Clear the buffer
+        '''
+        self.back = [[BLANK] * self.columns for _ in range(self.rows)]
+    
+    
+    def set_palette(self, colours : list):
+        '''
+        Set the console's colour palette with `\\e]P` on the next flush
+        
+        @param  colours:list<(red:int, green:int, blue:int)>  Up to 16 colours, for colour 0 and
+                                                              upwards, each channel is 0–255,
+                                                              values outside are clamped
+        '''
+        self.palette = [tuple(min(max(int(c), 0), 255) for c in colour) for colour in colours[:16]]
+    
+    
+    def draw(self, row : int, column : int, text : str, attr : str = '') -> (int, int, str):
+        '''
+        Draw text into the buffer, text outside the screen is clipped
+        
+        Newlines and tabs are interpreted, as are SGR escape
+        sequences, which for example `issue.Issue` produces;
+        other escape sequences are discarded
+        
+        @param   row:int     The row to start at, 0-based
+        @param   column:int  The column to start at, 0-based
+        @param   text:str    The text
+        @param   attr:str    The SGR parameters to start with, '' for default rendition
+        @return  :(row:int, column:int, attr:str)  The position and rendition after the text
+        '''
+        i, n = 0, len(text)
+        while i < n:
+            c = text[i]
+            i += 1
+            if c == '\033':
+                if (i < n) and (text[i] == '['):
+                    j = i + 1
+                    while (j < n) and not ('@' <= text[j] <= '~'):
+                        j += 1
+                    if (j < n) and (text[j] == 'm'):
+                        attr = update_attr(attr, text[i + 1 : j])
+                    i = j + 1
+                elif (i < n) and (text[i] == ']'):
+                    # OSC, terminated by BEL or ST, or seven hexadecimal digits for \e]P
+                    if text[i + 1 : i + 2] == 'P':
+                        i += 9
+                    else:
+                        while (i < n) and (text[i] not in '\a\033'):
+                            i += 1
+                        i += 2 if text[i : i + 2] == '\033\\' else 1
+                else:
+                    i += 1
+            elif c == '\n':
+                (row, column) = (row + 1, 0)
+            elif c == '\t':
+                column += 8 - column % 8
+            elif c >= ' ':
+                if (0 <= row < self.rows) and (0 <= column < self.columns):
+                    self.back[row][column] = (c, attr)
+                column += 1
+        return (row, column, attr)
+    
+    
+    def flush(self):
+        '''
+        Write the changes made since the last flush to the terminal
+        '''
+        out = []
+        if self.palette is not None:
+            for index, (red, green, blue) in enumerate(self.palette):
+                out.append('\033]P%X%02x%02x%02x' % (index, red, green, blue))
+            self.palette = None
+        front = self.front
+        if front is None:
+            out.append('\033[0m\033[H\033[2J')
+            front = [[BLANK] * self.columns for _ in range(self.rows)]
+            cursor = (0, 0)
+        else:
+            cursor = None
+        cur_attr = ''
+        for y in range(self.rows):
+            back_row, front_row = self.back[y], front[y]
+            if back_row == front_row:
+                continue
+            for x in range(self.columns):
+                cell = back_row[x]
+                if cell == front_row[x]:
+                    continue
+                (c, attr) = cell
+                if not cursor == (y, x):
+                    move = move_cursor(cursor, y, x)
+                    # Rewriting a few unchanged cells can be cheaper than moving past them
+                    skipped = back_row[cursor[1] : x] if (cursor is not None) and (cursor[0] == y) and (cursor[1] < x) else []
+                    if skipped and all(a == cur_attr for (_, a) in skipped):
+                        text = ''.join(s for (s, _) in skipped)
+                        if len(text.encode('utf-8')) <= len(move):
+                            move = text
+                    out.append(move)
+                if not attr == cur_attr:
+                    out.append('\033[0;%sm' % attr if attr else '\033[0m')
+                    cur_attr = attr
+                out.append(c)
+                front_row[x] = cell
+                # After the last column the cursor is left in a pending wrap state
+                cursor = (y, x + 1) if x + 1 < self.columns else None
+        if not cur_attr == '':
+            out.append('\033[0m')
+        self.front = front
+        data = ''.join(out).encode('utf-8')
+        while len(data) > 0:
+            data = data[os.write(self.fd, data):]
+
+
+def update_attr(attr : str, params : str) -> str:
+    '''
+    Apply SGR parameters to a rendition
+    
+    The arguments of extended colours, `38;5;n` and `38;2;r;g;b`
+    and likewise for 48, are not mistaken for parameters of their
+    own. Parameters that have been overridden are dropped, so the
+    rendition does not grow when parameters are repeated
+    
+    @param   attr:str    The current SGR parameters, '' for default rendition
+    @param   params:str  The parameters of an SGR escape sequence
+    @return  :str        The new SGR parameters
+    '''
+    params = (attr.split(';') if attr else []) + params.split(';')
+    slots = {}
+    i = 0
+    while i < len(params):
+        param = params[i]
+        code = param.split(':')[0]
+        code = int(code) if code.isdigit() else None
+        n = 1
+        if (code in (38, 48)) and (':' not in param) and (i + 1 < len(params)):
+            n = {'5' : 3, '2' : 5}.get(params[i + 1], 2)
+        group = ';'.join(params[i : i + n])
+        i += n
+        if (param == '') or (code == 0):
+            slots.clear()
+        elif code == 22:
+            slots.pop(1, None)
+            slots.pop(2, None)
+        elif (code is not None) and (23 <= code <= 29):
+            slots.pop(code - 20, None)
+        elif code in (39, 49):
+            slots.pop('fg' if code == 39 else 'bg', None)
+        else:
+            # Colours replace each other, other parameters replace only themselves
+            if (code is not None) and ((30 <= code <= 38) or (90 <= code <= 97)):
+                slot = 'fg'
+            elif (code is not None) and ((40 <= code <= 48) or (100 <= code <= 107)):
+                slot = 'bg'
+            else:
+                slot = param if code is None else code
+            slots.pop(slot, None)
+            slots[slot] = group
+    return ';'.join(slots.values())
+
+
+def move_cursor(cursor : (int, int), row : int, column : int) -> str:
+    '''
+    Get the shortest escape sequence that moves the cursor
+    
+    @param   cursor:(row:int, column:int)?  The current position, 0-based, `None` if unknown
+    @param   row:int                        The row to move to, 0-based
+    @param   column:int                     The column to move to, 0-based
+    @return  :str                           The escape sequence
+    '''
+    absolute = '\033[%i;%iH' % (row + 1, column + 1) if column > 0 else '\033[%iH' % (row + 1)
+    if cursor is None:
+        return absolute
+    candidates = [absolute]
+    (y, x) = cursor
+    if column == 0:
+        candidates.append('\r' + '\n' * (row - y) if row >= y else '\r\033[%iA' % (y - row))
+    elif row == y:
+        if column > x:
+            candidates.append('\033[C' if column - x == 1 else '\033[%iC' % (column - x))
+        else:
+            candidates.append('\b' * (x - column))
+    return min(candidates, key = len)
@@ -0,0 +1,325 @@
+# -*- python -*-
+'''
+exdm – The Extensible X Display Manager
+
+Copyright © 2015  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+from subprocess import Popen, DEVNULL
+
+from issue import SYSCONFDIR
+from xauth import RUNDIR, PKGNAME
+from metrics import SUBPROCESS_SECONDS
+
+
+SKEL_DIR = SYSCONFDIR + '/skel' # @@
+'''
+:str  The directory guest home directories are populated from
+'''
+
+GUEST_DIR = '%s/%s.guests' % (RUNDIR, PKGNAME)
+'''
+:str  The directory where guest home directories and pool state are kept
+'''
+
+GUEST_PREFIX = 'guest-'
+'''
+:str  The prefix of the names of guest accounts
+'''
+
+GUEST_POOL_SIZE = 2
+'''
+:int  The number of guest accounts to keep ready
+'''
+
+GUEST_HOME_SIZE = '25%'
+'''
+:str  The size limit of guest home directories, as understood by tmpfs
+'''
+
+GUEST_SHARED_DIRS = ('/tmp', '/var/tmp', '/dev/shm') # @@
+'''
+:tuple<str>  World-writable directories a guest may have left files in
+'''
+
+
+
+def run(command : list) -> bool:
+    '''
+    Run a command and wait for it to exit
+    
+    @param   command:list<str>  The command
+    @return  :bool              Whether the command was successful
+    '''
+    with SUBPROCESS_SECONDS.time(command = command[0]):
+        return Popen(command, stdin = DEVNULL, stdout = DEVNULL, stderr = sys.stderr).wait() == 0
+
+
+def get_guest_home(name : str) -> str:
+    '''
+    Get the home directory of a guest account
+    
+    @param   name:str  The name of the guest account
+    @return  :str      The home directory
+    '''
+    return '%s/%s' % (GUEST_DIR, name)
+
+
+def create_guest(name : str, busy : bool = False) -> bool:
+    '''
+    Create a guest account with a populated tmpfs home directory,
+    and mark it as ready to be used, or as in use
+    
+    The home directory is populated from `SKEL_DIR` with a plain
+    copy. Copy-on-write is not possible: reflinks cannot cross
+    filesystems and tmpfs does not support them, and an overlay
+    over `SKEL_DIR` would leave the files of the lower layer owned
+    by root, so the guest could not modify its own dotfiles
+    
+    @param   name:str   The name of the guest account
+    @param   busy:bool  Whether to mark the account as in use rather than ready
+    @return  :bool      Whether the account was created, if it
+                        already existed nothing is done
+    '''
+    import pwd
+    home = get_guest_home(name)
+    if not run(['useradd', '-M', '-U', '-d', home, '-c', 'Guest', '-s', '/bin/sh', name]):
+        return False
+    try:
+        user = pwd.getpwnam(name)
+        os.makedirs(home, mode = 0o700)
+        options = 'mode=0700,uid=%i,gid=%i,size=%s' % (user.pw_uid, user.pw_gid, GUEST_HOME_SIZE)
+        if not run(['mount', '-t', 'tmpfs', '-o', options, 'tmpfs', home]):
+            raise Exception()
+        if os.path.isdir(SKEL_DIR):
+            if not run(['cp', '-a', SKEL_DIR + '/.', home]):
+                raise Exception()
+            if not run(['chown', '-R', '%i:%i' % (user.pw_uid, user.pw_gid), home]):
+                raise Exception()
+        with open(home + ('.busy' if busy else '.ready'), 'wb'):
+            pass
+    except:
+        destroy_guest(name)
+        return False
+    return True
+
+
+def destroy_guest(name : str):
+    '''
+    Kill a guest's processes and remove its account, home directory
+    and the files it left in `GUEST_SHARED_DIRS`
+    
+    The files must be removed because `useradd` may give the
+    account's user ID to the next guest, who could otherwise
+    read them
+    
+    @param  name:str  The name of the guest account
+    '''
+    import pwd
+    home = get_guest_home(name)
+    run(['pkill', '-KILL', '-U', name])
+    try:
+        uid = pwd.getpwnam(name).pw_uid
+        for directory in GUEST_SHARED_DIRS:
+            if os.path.isdir(directory):
+                run(['find', directory, '-xdev', '-uid', str(uid), '-delete'])
+    except KeyError:
+        pass
+    if os.path.ismount(home):
+        run(['umount', '-l', home])
+    run(['userdel', name])
+    for pathname in (home + '.ready', home + '.busy'):
+        try:
+            os.unlink(pathname)
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(home)
+    except OSError:
+        pass
+
+
+class GuestPool:
+    '''
+    Pool of guest accounts that are ready to be used
+    
+    The pool's state is kept in the filesystem, as `.ready` and `.busy`
+    files besides the home directories in `GUEST_DIR`, so that it can be
+    shared by the display managers of all seats: an account is claimed by
+    atomically renaming its `.ready` file. Accounts are created and
+    removed by a background thread, so neither delays logins.
+    Creation, removal and the clean up at start are serialised
+    between seats with a lock on `GUEST_DIR/.lock`
+    
+    @variable  size:int  The number of accounts to keep ready
+    '''
+    
+    def __init__(self, size : int = GUEST_POOL_SIZE):
+        '''
+        Constructor
+        
+        @param  size:int  The number of accounts to keep ready
+        '''
+        import queue, signal, threading
+        self.size = size
+        self.__tasks = queue.Queue()
+        os.makedirs(GUEST_DIR, mode = 0o755, exist_ok = True)
+        # The thread inherits the signal mask, keep signals meant for
+        # xserver.wait_for_server from being delivered to it
+        sigmask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGUSR1, signal.SIGCHLD])
+        try:
+            threading.Thread(target = self.__work, daemon = True).start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, sigmask)
+        self.__tasks.put(lambda : self.__locked(self.__reconcile))
+        self.refill()
+    
+    
+    def __work(self):
+        '''
+        Perform queued creations and removals, forever
+        '''
+        while True:
+            task = self.__tasks.get()
+            try:
+                task()
+            except Exception as err:
+                print('%s: guest pool: %s' % (sys.argv[0], err), file = sys.stderr)
+    
+    
+    def __locked(self, function : callable):
+        '''
+        Call a function while holding the lock shared by the pools of all seats
+        
+        @param   function:()→¿R  The function
+        @return  :¿R             The function's return value
+        '''
+        import fcntl
+        fd = os.open(GUEST_DIR + '/.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return function()
+        finally:
+            os.close(fd)
+    
+    
+    def __reconcile(self):
+        '''
+        Remove guest accounts that have neither a `.ready` nor a `.busy`
+        file, for example because `GUEST_DIR` was cleared by a reboot
+        '''
+        import pwd
+        for user in pwd.getpwall():
+            (name, home) = (user.pw_name, user.pw_dir)
+            if not (name.startswith(GUEST_PREFIX) and name[len(GUEST_PREFIX):].isdigit()):
+                continue
+            if not home == get_guest_home(name):
+                # Not created by us
+                continue
+            if not (os.path.exists(home + '.ready') or os.path.exists(home + '.busy')):
+                destroy_guest(name)
+    
+    
+    def __ready(self) -> list:
+        '''
+        List the ready guest accounts
+        
+        @return  :list<str>  The names of the ready guest accounts
+        '''
+        return [f[:-len('.ready')] for f in os.listdir(GUEST_DIR) if f.endswith('.ready')]
+    
+    
+    def __create_unlocked(self, busy : bool) -> str:
+        '''
+        Create a guest account under the first unused name,
+        the caller must hold the lock
+        
+        @param   busy:bool  Whether to mark the account as in use rather than ready
+        @return  :str?      The name of the guest account, `None` on failure
+        '''
+        for index in range(1, 1000):
+            name = '%s%i' % (GUEST_PREFIX, index)
+            if not os.path.lexists(get_guest_home(name)):
+                # Fails if the name is taken by an account that is not ours
+                if create_guest(name, busy):
+                    return name
+        return None
+    
+    
+    def __create(self, busy : bool = False) -> str:
+        '''
+        Create a guest account under the first unused name
+        
+        @param   busy:bool  Whether to mark the account as in use rather than ready
+        @return  :str?      The name of the guest account, `None` on failure
+        '''
+        return self.__locked(lambda : self.__create_unlocked(busy))
+    
+    
+    def __fill(self):
+        '''
+        Create guest accounts until `size` of them are ready
+        '''
+        def create_if_needed():
+            # Counted under the lock, as the pools of other seats fill the same directory
+            if len(self.__ready()) >= self.size:
+                return None
+            return self.__create_unlocked(False)
+        while self.__locked(create_if_needed) is not None:
+            pass
+    
+    
+    def refill(self):
+        '''
+        Top up the pool in the background
+        '''
+        self.__tasks.put(self.__fill)
+    
+    
+    def acquire(self) -> str:
+        '''
+        Claim a guest account
+        
+        If none is ready, one is created immediately
+        
+        @return  :str?  The name of the guest account, `None` on failure
+        '''
+        for name in self.__ready():
+            home = get_guest_home(name)
+            try:
+                os.rename(home + '.ready', home + '.busy')
+            except FileNotFoundError:
+                # Claimed by another seat
+                continue
+            self.refill()
+            return name
+        # Created directly as in use, so that no other seat can claim it
+        name = self.__create(True)
+        self.refill()
+        return name
+    
+    
+    def release(self, name : str):
+        '''
+        Remove a guest account in the background after its session
+        has ended, and top up the pool
+        
+        @param  name:str  The name of the guest account
+        '''
+        self.__tasks.put(lambda : self.__locked(lambda : destroy_guest(name)))
+        self.refill()
@@ -20,8 +20,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import sys
+import socket
 from subprocess import Popen, PIPE
 
+from netaddr import get_address_provider
+from metrics import SUBPROCESS_SECONDS
+
 
 SYSCONFDIR = '/etc' # @@
 '''
@@ -75,13 +79,20 @@ class Issue:
         
         def sh(command):
             p = ['sh', '-c', command]
-            p = Popen(p, stdin = sys.stdin, stdout = PIPE, stderr = sys.stderr)
-            p = p.communicate()[0].decode('utf-8', 'replace')
+            with SUBPROCESS_SECONDS.time(command = 'sh'):
+                p = Popen(p, stdin = sys.stdin, stdout = PIPE, stderr = sys.stderr)
+                p = p.communicate()[0].decode('utf-8', 'replace')
             return p.rstrip('\n')
         buf = ''
         esc = False
         skip_arg = False
-        inet = lambda ip, face = '' : sh("ifconfig %s | grep '^ *%s ' | grep -Po '%s [^ ]*' | cut -d ' ' -f 2 | sed 1q" % (face, ip, ip))
+        netaddr = get_address_provider()
+        def inet(ip, face = ''):
+            if netaddr is not None:
+                family = socket.AF_INET if ip == 'inet' else socket.AF_INET6
+                address = netaddr.get(family, face if not face == '' else None)
+                return '' if address is None else address
+            return sh("ifconfig %s | grep '^ *%s ' | grep -Po '%s [^ ]*' | cut -d ' ' -f 2 | sed 1q" % (face, ip, ip))
         uname = os.uname()
         for i in range(len(issue_data)):
             c = issue_data[i]
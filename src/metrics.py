@@ -0,0 +1,289 @@
+# -*- python -*-
+'''
+exdm – The Extensible X Display Manager
+
+Copyright © 2015  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+'''
+:tuple<float>  The default upper bounds, in seconds, of histogram buckets
+'''
+
+
+class Counter:
+    '''
+    Monotonically increasing metric
+    
+    Updates are not locked, they are cheap enough to be made from
+    signal handlers, and a lost update under contention is acceptable
+    
+    @variable  name:str                               The name of the metric
+    @variable  help:str                               The description of the metric
+    @variable  values:dict<tuple<(str, str)>, float>  Labels → value
+    '''
+    
+    def __init__(self, name : str, help : str):
+        '''
+        Constructor
+        
+        @param  name:str  The name of the metric
+        @param  help:str  The description of the metric
+        '''
+        self.name   = name
+        self.help   = help
+        self.values = {}
+        REGISTRY.append(self)
+    
+    
+    def inc(self, amount : float = 1, **labels):
+        '''
+        Increase the value of the metric
+        
+        @param  amount:float  The amount to increase the value by
+        @param  labels:str    The labels of the time series to increase
+        '''
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+    
+    
+    def expose(self, seat : str) -> list:
+        '''
+        Format the metric in Prometheus text exposition format
+        
+        @param   seat:str    The value of the seat label
+        @return  :list<str>  The lines of the metric
+        '''
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        for key, value in list(self.values.items()):
+            lines.append('%s{%s} %s' % (self.name, format_labels(seat, key), repr(float(value))))
+        return lines
+
+
+class Histogram:
+    '''
+    Distribution of observed values, usually durations in seconds
+    
+    @variable  name:str                                     The name of the metric
+    @variable  help:str                                     The description of the metric
+    @variable  buckets:tuple<float>                         The upper bounds of the buckets
+    @variable  values:dict<tuple<(str, str)>, list<float>>  Labels → [bucket counts..., count, sum]
+    '''
+    
+    def __init__(self, name : str, help : str, buckets : tuple = DEFAULT_BUCKETS):
+        '''
+        Constructor
+        
+        @param  name:str              The name of the metric
+        @param  help:str              The description of the metric
+        @param  buckets:tuple<float>  The upper bounds of the buckets, in ascending order
+        '''
+        self.name    = name
+        self.help    = help
+        self.buckets = buckets
+        self.values  = {}
+        REGISTRY.append(self)
+    
+    
+    def observe(self, value : float, **labels):
+        '''
+        Record an observation
+        
+        @param  value:float  The observed value
+        @param  labels:str   The labels of the time series to record the observation in
+        '''
+        key = tuple(sorted(labels.items()))
+        counts = self.values.get(key, None)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += 1
+        counts[-1] += value
+    
+    
+    def expose(self, seat : str) -> list:
+        '''
+        Format the metric in Prometheus text exposition format
+        
+        @param   seat:str    The value of the seat label
+        @return  :list<str>  The lines of the metric
+        '''
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for key, counts in list(self.values.items()):
+            counts = list(counts)
+            labels = format_labels(seat, key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %i' % (self.name, labels, repr(float(bound)), cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %i' % (self.name, labels, counts[-2]))
+            lines.append('%s_count{%s} %i' % (self.name, labels, counts[-2]))
+            lines.append('%s_sum{%s} %s' % (self.name, labels, repr(float(counts[-1]))))
+        return lines
+    
+    
+    def time(self, **labels):
+        '''
+        Create a context manager that records the time spent in it
+        
+        @param   labels:str  The labels of the time series to record the observation in
+        @return              The context manager
+        '''
+        from contextlib import contextmanager
+        @contextmanager
+        def timer():
+            start = time.monotonic()
+            try:
+                yield
+            finally:
+                self.observe(time.monotonic() - start, **labels)
+        return timer()
+
+
+def format_labels(seat : str, key : tuple) -> str:
+    '''
+    Format the labels of a time series
+    
+    @param   seat:str               The value of the seat label
+    @param   key:tuple<(str, str)>  The other labels
+    @return  :str                   The labels, without the surrounding braces
+    '''
+    escape = lambda v : str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('%s="%s"' % (k, escape(v)) for (k, v) in (('seat', seat),) + key)
+
+
+REGISTRY = []
+'''
+:list<Counter|Histogram>  All metrics
+'''
+
+XSERVER_START_SECONDS = Histogram('exdm_xserver_start_seconds',
+                                  'Time taken to fork the X server')
+XSERVER_READY_SECONDS = Histogram('exdm_xserver_ready_seconds',
+                                  'Time from starting the X server until it signalled readiness')
+XSERVER_CRASHES = Counter('exdm_xserver_crashes_total',
+                          'X servers that died before they were stopped')
+DISPLAY_ATTEMPTS = Counter('exdm_display_allocation_attempts_total',
+                           'Attempts to allocate an X display, by outcome')
+SUBPROCESS_SECONDS = Histogram('exdm_subprocess_seconds',
+                               'Time from spawning a subprocess until it was joined, by command')
+AUTH_SECONDS = Histogram('exdm_authentication_seconds',
+                         'Time taken to set up X server authentication')
+AUTH_FAILURES = Counter('exdm_authentication_failures_total',
+                        'Failed attempts to set up X server authentication')
+RESPAWNS = Counter('exdm_respawns_total',
+                   'Times exdm was started after it had crashed on the seat')
+
+
+def expose_metrics() -> str:
+    '''
+    Format all metrics in Prometheus text exposition format
+    
+    @return  :str  The metrics
+    '''
+    seat = 'vt%s' % os.environ.get('XDG_VTNR', '')
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.expose(seat)
+    return '\n'.join(lines) + '\n'
+
+
+def get_metrics_socket_pathname() -> str:
+    '''
+    Get the pathname of the metrics socket
+    
+    The environment variable XDG_VTNR must be set
+    
+    @return  :str  The pathname of the metrics socket
+    '''
+    from xauth import RUNDIR, PKGNAME
+    return '%s/%s.vt%s.metrics' % (RUNDIR, PKGNAME, os.environ['XDG_VTNR'])
+
+
+__metrics_socket = None
+def serve_metrics() -> bool:
+    '''
+    Start serving the metrics on a Unix socket, each connection
+    is sent the current metrics and is then closed
+    
+    The environment variable XDG_VTNR must be set
+    
+    @return  :bool  Whether the socket could be created
+    '''
+    import socket, sys, signal, threading
+    global __metrics_socket
+    pathname = get_metrics_socket_pathname()
+    try:
+        try:
+            os.unlink(pathname)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(pathname)
+        os.chmod(pathname, 0o600)
+        sock.listen(8)
+    except OSError as err:
+        print('%s: cannot serve metrics on %s: %s' % (sys.argv[0], pathname, err.strerror), file = sys.stderr)
+        return False
+    __metrics_socket = sock
+    def serve():
+        while True:
+            try:
+                (conn, _addr) = sock.accept()
+            except OSError:
+                break
+            try:
+                conn.sendall(expose_metrics().encode('utf-8'))
+            except OSError:
+                pass
+            finally:
+                conn.close()
+    # The thread inherits the signal mask, SIGUSR1 and SIGCHLD must be left to
+    # xserver.wait_for_server in the main thread, they would be lost in this thread
+    sigmask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGUSR1, signal.SIGCHLD])
+    try:
+        threading.Thread(target = serve, daemon = True).start()
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, sigmask)
+    return True
+
+
+def stop_metrics():
+    '''
+    Stop serving the metrics and remove the socket
+    '''
+    global __metrics_socket
+    if __metrics_socket is None:
+        return
+    import socket
+    try:
+        os.unlink(get_metrics_socket_pathname())
+    except:
+        pass
+    try:
+        # Wake up the thread blocked in accept
+        __metrics_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    __metrics_socket.close()
+    __metrics_socket = None
@@ -30,11 +30,16 @@ def set_environment_from_cmdline(cmdline):
     '''
     Set up environment variables according to the command line
     
+    The variables are protected from being changed by reloaded configurations
+    
     @param  cmdline:ArgParser  The command line parser
     '''
     from util import setenv
-    for var, val in [(a.split('=')[0], '='.join(a.split('=')[1:])) for a in cmdline.files if '=' in a]:
+    from config import protect_environment
+    variables = [(a.split('=')[0], '='.join(a.split('=')[1:])) for a in cmdline.files if '=' in a]
+    for var, val in variables:
         setenv(var, val)
+    protect_environment(var for var, val in variables)
 
 
 def get_virtual_terminal(cmdline) -> int:
@@ -48,14 +53,20 @@ def get_virtual_terminal(cmdline) -> int:
     '''
     import sys
     from subprocess import Popen, PIPE
-    from util import setenv
+    from util import setenv, is_numeral
+    from config import get_configuration
+    from metrics import SUBPROCESS_SECONDS
+    conf = get_configuration()
     vt = [int(a[2:]) for a in cmdline.files if a.startswith('vt') and is_numeral(a[2:])]
     vt = [a for a in vt if 0 < a < 64]
     if len(vt) == 1:
         [vt] = vt
+    elif (conf is not None) and (conf.vt is not None):
+        vt = conf.vt
     else:
-        proc = Popen(['fgconsole', '--next-available'], stdin = sys.stdin, sysout = PIPE)
-        vt = int(proc.communicate()[0].decode('utf-8', 'strict').strip())
+        with SUBPROCESS_SECONDS.time(command = 'fgconsole'):
+            proc = Popen(['fgconsole', '--next-available'], stdin = sys.stdin, stdout = PIPE)
+            vt = int(proc.communicate()[0].decode('utf-8', 'strict').strip())
     setenv('XDG_VTNR', str(vt))
     print('%s: opening %s on vt%i' % (sys.argv[0], PROGRAM_NAME, vt), file = sys.stderr)
     return vt
@@ -80,8 +91,10 @@ def get_mit_cookie(authfile : str) -> str:
     '''
     import os
     from xauth import generate_mit_cookie
+    from metrics import RESPAWNS
     if os.path.exists(authfile + '.raw'):
         # Incase the program crashed and was respawned
+        RESPAWNS.inc()
         with open(authfile + '.raw', 'rb') as file:
             mit_cookie = file.read().decode('utf-8', 'strict').strip()
     else:
@@ -89,21 +102,51 @@ def get_mit_cookie(authfile : str) -> str:
     return mit_cookie
 
 
-def configure_signals(signal_handler : callable):
+def configure_signals(signal_handler : callable, reload_handler : callable = None):
     '''
     Configure signals
     
-    @param  signal_handler:(signal:int, stack)→void  Function to call when the display
-                                                     manager should exit because of a signal
+    @param  signal_handler:(signal:int, stack)→void   Function to call when the display
+                                                      manager should exit because of a signal
+    @param  reload_handler:(signal:int, stack)→void?  Function to call when the configurations
+                                                      should be reloaded, `None` to exit instead
     '''
     import signal
-    def signal_do_nothing(signal, stack):
+    from xserver import mark_server_ready
+    def signal_do_nothing(sig, stack):
+        # The X server sends SIGUSR1 when it is ready
+        mark_server_ready()
         signal.signal(signal.SIGUSR1, signal_do_nothing)
     signal.signal(signal.SIGQUIT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    signal.signal(signal.SIGKILL, signal_handler)
     signal.signal(signal.SIGINT,  signal_handler)
-    signal.signal(signal.SIGHUP,  signal_handler)
+    signal.signal(signal.SIGHUP,  signal_handler if reload_handler is None else reload_handler)
     signal.signal(signal.SIGPIPE, signal_handler)
     signal.signal(signal.SIGUSR1, signal_do_nothing)
 
+
+
+__misc_terminating = False
+def terminate(status : int):
+    '''
+    Stop the X server, remove server authentication and exit
+    
+    Calls made while a termination is already in progress, for example
+    from a signal handler, are ignored
+    
+    @param  status:int  The exit status of the display manager
+    '''
+    import sys
+    from xserver import stop_server
+    from xauth import remove_authentication_file
+    from metrics import stop_metrics
+    global __misc_terminating
+    if __misc_terminating:
+        return
+    __misc_terminating = True
+    try:
+        stop_server()
+    finally:
+        remove_authentication_file()
+        stop_metrics()
+    sys.exit(status)
@@ -0,0 +1,199 @@
+# -*- python -*-
+'''
+exdm – The Extensible X Display Manager
+
+Copyright © 2015  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import socket
+import struct
+
+
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x001
+NLM_F_DUMP    = 0x300
+NLMSG_ERROR   = 2
+NLMSG_DONE    = 3
+NLMSG_HEADER  = struct.Struct('=IHHII')
+RTM_NEWADDR   = 20
+RTM_DELADDR   = 21
+RTM_GETADDR   = 22
+IFADDRMSG     = struct.Struct('=BBBBI')
+RTATTR        = struct.Struct('=HH')
+IFA_ADDRESS   = 1
+IFA_LOCAL     = 2
+RTMGRP_IPV4_IFADDR = 0x010
+RTMGRP_IPV6_IFADDR = 0x100
+
+
+
+class AddressProvider:
+    '''
+    Index of the network interfaces' addresses, read from rtnetlink
+    
+    The index is built from a single RTM_GETADDR dump and is then kept
+    up to date by draining address change notifications, which is only
+    a non-blocking `recv` when nothing has changed
+    
+    @variable  addresses:dict<int, list<(family:int, address:str)>>  Interface index → addresses,
+                                                                     in the order the kernel reported them
+    @variable  names:dict<str, int>                                  Interface name → interface index
+    @variable  monitor:socket                                        Socket receiving address change notifications
+    '''
+    
+    def __init__(self):
+        '''
+        Constructor
+        
+        @throws  OSError  If rtnetlink is not available
+        '''
+        self.addresses = {}
+        self.names = {}
+        self.monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK, NETLINK_ROUTE)
+        try:
+            self.monitor.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            self.dump()
+        except:
+            self.monitor.close()
+            raise
+    
+    
+    def close(self):
+        '''
+        Stop listening for address changes
+        '''
+        self.monitor.close()
+    
+    
+    def dump(self):
+        '''
+        Rebuild the index from scratch
+        '''
+        self.addresses = {}
+        self.names = dict((name, index) for (index, name) in socket.if_nameindex())
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        try:
+            sock.bind((0, 0))
+            request = NLMSG_HEADER.pack(NLMSG_HEADER.size + IFADDRMSG.size, RTM_GETADDR,
+                                        NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+            sock.send(request + IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+            done = False
+            while not done:
+                done = self.__parse(sock.recv(1 << 16))
+        finally:
+            sock.close()
+    
+    
+    def update(self):
+        '''
+        Apply all pending address change notifications
+        '''
+        while True:
+            try:
+                data = self.monitor.recv(1 << 16)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Notifications were lost (ENOBUFS), start over
+                self.dump()
+                break
+            self.__parse(data)
+    
+    
+    def __parse(self, data : bytes) -> bool:
+        '''
+        Apply a buffer of rtnetlink messages to the index
+        
+        @param   data:bytes  The received messages
+        @return  :bool       Whether the end of a dump was reached
+        '''
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            (length, msgtype, _flags, _seq, _pid) = NLMSG_HEADER.unpack_from(data, offset)
+            if length < NLMSG_HEADER.size:
+                break
+            if msgtype in (NLMSG_DONE, NLMSG_ERROR):
+                return True
+            if msgtype in (RTM_NEWADDR, RTM_DELADDR):
+                body = offset + NLMSG_HEADER.size
+                (family, _prefixlen, _flags, _scope, index) = IFADDRMSG.unpack_from(data, body)
+                attrs, attrs_end = {}, offset + length
+                pos = body + IFADDRMSG.size
+                while pos + RTATTR.size <= attrs_end:
+                    (attrlen, attrtype) = RTATTR.unpack_from(data, pos)
+                    if attrlen < RTATTR.size:
+                        break
+                    attrs[attrtype] = data[pos + RTATTR.size : pos + attrlen]
+                    pos += (attrlen + 3) & ~3
+                # IFA_LOCAL is the local address on point-to-point
+                # interfaces, where IFA_ADDRESS is the peer's address
+                raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS, None))
+                if (raw is not None) and (family in (socket.AF_INET, socket.AF_INET6)):
+                    entry = (family, socket.inet_ntop(family, raw))
+                    entries = self.addresses.setdefault(index, [])
+                    if msgtype == RTM_DELADDR:
+                        if entry in entries:
+                            entries.remove(entry)
+                    elif entry not in entries:
+                        entries.append(entry)
+                        if index not in self.names.values():
+                            self.names = dict((name, i) for (i, name) in socket.if_nameindex())
+            offset += (length + 3) & ~3
+        return False
+    
+    
+    def get(self, family : int, interface : str = None) -> str:
+        '''
+        Get the first address of an interface
+        
+        @param   family:int      `socket.AF_INET` or `socket.AF_INET6`
+        @param   interface:str?  The name of the interface, `None` for the first
+                                 address on any interface other than loopback
+        @return  :str?           The address, `None` if there is none
+        '''
+        self.update()
+        if interface is not None:
+            if interface not in self.names:
+                # The interface may have been added or renamed
+                self.names = dict((name, i) for (i, name) in socket.if_nameindex())
+            if interface not in self.names:
+                return None
+            indices = [self.names[interface]]
+        else:
+            loopbacks = set(self.names.get(name, -1) for name in ('lo', 'lo0'))
+            indices = sorted(i for i in self.addresses.keys() if i not in loopbacks)
+        for index in indices:
+            for (fam, address) in self.addresses.get(index, []):
+                if fam == family:
+                    return address
+        return None
+
+
+__netaddr_provider = None
+__netaddr_unavailable = False
+def get_address_provider() -> AddressProvider:
+    '''
+    Get the shared network interface address provider
+    
+    @return  :AddressProvider?  The address provider, `None` if rtnetlink is not available
+    '''
+    global __netaddr_provider, __netaddr_unavailable
+    if (__netaddr_provider is None) and not __netaddr_unavailable:
+        try:
+            __netaddr_provider = AddressProvider()
+        except (OSError, AttributeError):
+            __netaddr_unavailable = True
+    return __netaddr_provider
@@ -91,14 +91,17 @@ def get_hostname() -> str:
     else:
         import os, sys
         from subprocess import Popen, PIPE
+        from metrics import SUBPROCESS_SECONDS
         command = ['hostname']
         if os.uname().sysname.startswith('Linux'):
-            proc = Popen(command + ['--version'], stdout = PIPE, stderr = PIPE)
-            out, err = proc.communicate()
-            if 'GNU' not in (out + err):
+            with SUBPROCESS_SECONDS.time(command = 'hostname'):
+                proc = Popen(command + ['--version'], stdout = PIPE, stderr = PIPE)
+                out, err = proc.communicate()
+            if b'GNU' not in (out + err):
                 command.append('-f')
-        proc = Popen(command, stdout = PIPE, stderr = sys.stderr)
-        hostname = proc.communicate()[0].strip()
+        with SUBPROCESS_SECONDS.time(command = 'hostname'):
+            proc = Popen(command, stdout = PIPE, stderr = sys.stderr)
+            hostname = proc.communicate()[0].decode('utf-8', 'strict').strip()
         __util_hostname = hostname
         return hostname
 
@@ -124,3 +127,53 @@ def timedwaitpid(pid : int, periods : int, interval : float = 1) -> int:
         time.sleep(interval)
     return None
 
+
+
+def pidfd_wait(pid : int, timeout : float) -> bool:
+    '''
+    Wait, without reaping it, for a child process to die, but not longer than a deadline
+    
+    A pidfd is used so that the wait is woken up as soon as the process dies
+    rather than on the next polling period. If pidfds are not supported by the
+    kernel or by Python, `timedwaitpid` is used instead, in which case the
+    process will be reaped if it dies
+    
+    @param   pid:int        The ID of the process to wait
+    @param   timeout:float  The maximum number of seconds to wait
+    @return  :bool          Whether the process has died
+    '''
+    import os, select
+    # poll(2) takes a signed 32-bit number of milliseconds
+    timeout = min(max(0, timeout), ((1 << 31) - 1) / 1000)
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        periods = max(1, int(timeout * 10))
+        return timedwaitpid(pid, periods, timeout / periods) is not None
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        return len(poller.poll(int(timeout * 1000))) > 0
+    finally:
+        os.close(pidfd)
+
+
+def reap_children() -> int:
+    '''
+    Reap all child processes that have died, without blocking
+    
+    @return  :int  The number of reaped child processes
+    '''
+    import os
+    reaped = 0
+    while True:
+        try:
+            (pid, status) = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            break
+        reaped += 1
+    return reaped
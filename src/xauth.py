@@ -29,6 +29,16 @@ PKGNAME = 'exdm' # @@
 :str  The name of the page as installed
 '''
 
+TMPDIR = '/tmp' # @@
+'''
+:str  The installed system's path for /tmp, where X servers keep their lock files
+'''
+
+RESERVATION_DIR = RUNDIR
+'''
+:str  The directory where displays are reserved, it must only be writable by root
+'''
+
 
 
 def generate_mit_cookie() -> str:
@@ -52,11 +62,13 @@ def get_display_with_cookie(mit_cookie : str, default_display = None) -> int:
     import sys
     from subprocess import Popen, PIPE
     from util import get_hostname
-    command = 'xauth list | grep "^%s/unix:" | grep "[[:space:]]%s$" | cut -f 1 | cut -d ' ' -f 1 | sed 1q'
+    from metrics import SUBPROCESS_SECONDS
+    command = 'xauth list | grep "^%s/unix:" | grep "[[:space:]]%s$" | cut -f 1 | cut -d \' \' -f 1 | sed 1q'
     command %= (get_hostname(), mit_cookie)
     command = ['sh', '-c', command]
-    proc = Popen(command, stdout = PIPE, stderr = sys.stderr)
-    display = proc.communicate()[0].decode('utf-8', 'strict').strip()
+    with SUBPROCESS_SECONDS.time(command = 'xauth'):
+        proc = Popen(command, stdout = PIPE, stderr = sys.stderr)
+        display = proc.communicate()[0].decode('utf-8', 'strict').strip()
     if len(display) == 0:
         display = default_display
     else:
@@ -76,34 +88,169 @@ def create_authentication_file(authfile : str, display : int, mit_cookie : str)
     import sys
     from subprocess import Popen, PIPE
     from util import get_hostname
+    from metrics import SUBPROCESS_SECONDS
     
     # Attempt to create authentication file
-    proc = Popen(['xauth', '-f', authfile, '-q'], stdin = PIPE, stdout = sys.stdout, stderr = sys.stderr)
-    proc.stdin.write(('add :%i . %s\n' % (display, mit_cookie)).encode('utf-8'))
-    proc.stdin.write(('exit %s\n').encode('utf-8'))
-    proc.wait()
+    with SUBPROCESS_SECONDS.time(command = 'xauth'):
+        proc = Popen(['xauth', '-f', authfile, '-q'], stdin = PIPE, stdout = sys.stdout, stderr = sys.stderr)
+        proc.stdin.write(('add :%i . %s\n' % (display, mit_cookie)).encode('utf-8'))
+        proc.stdin.write(('exit %s\n').encode('utf-8'))
+        proc.stdin.close()
+        proc.wait()
     
     # Test that we were successful
     command = 'xauth list | sed -n "s/^%s\/unix:%i[[:space:]*].*[[:space:]*]//p"'
     command = ['sh', '-c', command % (get_hostname(), display)]
-    proc = Popen(command, stdout = PIPE, stderr = sys.stderr)
-    test_cookie = proc.communicate()[0].decode('utf-8', 'strict').strip()
+    with SUBPROCESS_SECONDS.time(command = 'xauth'):
+        proc = Popen(command, stdout = PIPE, stderr = sys.stderr)
+        test_cookie = proc.communicate()[0].decode('utf-8', 'strict').strip()
     return test_cookie == mit_cookie
 
 
+def add_authentication(authfile : str, display : str, mit_cookie : str) -> bool:
+    '''
+    Add a cookie for a display, possibly remote, to an authentication file
+    
+    @param   authfile:str    The authentication file's pathname
+    @param   display:str     The display name, for example `host:0`
+    @param   mit_cookie:str  The cookie for the display
+    @return  :bool           Whether the cookie was added
+    '''
+    import os, sys
+    from subprocess import Popen, PIPE
+    from metrics import SUBPROCESS_SECONDS
+    if not os.path.exists(authfile):
+        # Create it with restricted permissions before xauth does
+        try:
+            os.close(os.open(authfile, os.O_WRONLY | os.O_CREAT, 0o600))
+        except OSError:
+            return False
+    with SUBPROCESS_SECONDS.time(command = 'xauth'):
+        proc = Popen(['xauth', '-f', authfile, '-q'], stdin = PIPE, stdout = sys.stdout, stderr = sys.stderr)
+        proc.stdin.write(('add %s . %s\n' % (display, mit_cookie)).encode('utf-8'))
+        proc.stdin.write(('exit\n').encode('utf-8'))
+        proc.stdin.close()
+        return proc.wait() == 0
+
+
+def is_display_in_use(display : int) -> bool:
+    '''
+    Check whether an X server is running on a display
+    
+    @param   display:int  The index of the X display
+    @return  :bool        Whether the display's lock file is held by a running process
+    '''
+    import os
+    try:
+        with open('%s/.X%i-lock' % (TMPDIR, display), 'rb') as file:
+            pid = int(file.read().decode('utf-8', 'replace').strip())
+    except FileNotFoundError:
+        return False
+    except:
+        # Unreadable, let the X server decide whether it is stale
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+__xauth_reservation = None
+def reserve_display(display : int) -> bool:
+    '''
+    Reserve a display against other instances of the display manager
+    
+    A display is reserved by holding an exclusive `flock` on
+    `RESERVATION_DIR/exdm.display<n>.lock`. The lock is released by
+    the kernel if the display manager dies, so reservations cannot go
+    stale. The X server's own lock file cannot be used because the X
+    server refuses to start if it is held by a running process, and
+    because anyone could hold locks in the world-writable `TMPDIR`
+    
+    @param   display:int  The index of the X display
+    @return  :bool        Whether the display was reserved, `False` if another
+                          instance of the display manager has reserved it
+    '''
+    import os, fcntl
+    global __xauth_reservation
+    if (__xauth_reservation is not None) and (__xauth_reservation[0] == display):
+        return True
+    release_display()
+    pathname = '%s/%s.display%i.lock' % (RESERVATION_DIR, PKGNAME, display)
+    while True:
+        try:
+            fd = os.open(pathname, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        except OSError:
+            # For example a symbolic link
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        try:
+            # The holder may have unlinked the file before we locked it
+            if os.stat(pathname).st_ino == os.fstat(fd).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+    __xauth_reservation = (display, fd, pathname)
+    return True
+
+
+def release_display():
+    '''
+    Release the display reserved by `reserve_display`, if any
+    '''
+    import os
+    global __xauth_reservation
+    if __xauth_reservation is None:
+        return
+    (_display, fd, pathname) = __xauth_reservation
+    __xauth_reservation = None
+    # Unlink before unlocking, `reserve_display` checks that the locked file is still linked
+    try:
+        os.unlink(pathname)
+    except OSError:
+        pass
+    os.close(fd)
+
+
+__xauth_created = False
 def remove_authentication_file():
     '''
     Remove server authentication
     
-    The environment variables XAUTHORITY and DISPLAY must be set
+    This function only has an effect the first time it is called
+    after the authentication file has been created by `get_display`,
+    it is therefore safe to call from both signal handlers and the
+    normal exit path
+    
+    The environment variable XAUTHORITY must be set if
+    the authentication file has been created
+    
+    The display's reservation is also released
     '''
     import os, sys
     from subprocess import Popen, PIPE
+    from metrics import SUBPROCESS_SECONDS
+    global __xauth_created
+    release_display()
+    if not __xauth_created:
+        return
+    __xauth_created = False
     authfile = os.environ['XAUTHORITY']
-    proc = Popen(['xauth', '-f', authfile, '-q'], stdin = PIPE, stdout = sys.stdout, stderr = sys.stderr)
-    proc.stdin.write(('remove %s\n' % os.environ['DISPLAY']).encode('utf-8'))
-    proc.stdin.write(('exit %s\n').encode('utf-8'))
-    proc.wait()
+    if 'DISPLAY' in os.environ:
+        with SUBPROCESS_SECONDS.time(command = 'xauth'):
+            proc = Popen(['xauth', '-f', authfile, '-q'], stdin = PIPE, stdout = sys.stdout, stderr = sys.stderr)
+            proc.stdin.write(('remove %s\n' % os.environ['DISPLAY']).encode('utf-8'))
+            proc.stdin.write(('exit %s\n').encode('utf-8'))
+            proc.stdin.close()
+            proc.wait()
     try:
         os.unlink(authfile)
     except:
@@ -122,13 +269,17 @@ def get_display() -> str:
     
     @return  :mit_cookie:str?  The cookie, `None` on failure
     '''
-    import os
+    import os, sys, time
     from util import setenv
     from misc import get_mit_cookie
+    from metrics import AUTH_SECONDS, AUTH_FAILURES, DISPLAY_ATTEMPTS
+    global __xauth_created
+    started = time.monotonic()
     
     # Get and export authentication file
     authfile = '%s/%s.vt%s.auth' % (RUNDIR, PKGNAME, os.environ['XDG_VTNR'])
     setenv('XAUTHORITY', authfile)
+    __xauth_created = True
     
     # Get cookie
     mit_cookie = get_mit_cookie(authfile)
@@ -142,13 +293,25 @@ def get_display() -> str:
     
     # Create server authentication file
     while display < 256:
-        if create_authentication_file(authfile, display, mit_cookie):
+        if not reserve_display(display):
+            DISPLAY_ATTEMPTS.inc(outcome = 'in_use')
+            display += 1
+        elif is_display_in_use(display):
+            DISPLAY_ATTEMPTS.inc(outcome = 'in_use')
+            release_display()
+            display += 1
+        elif create_authentication_file(authfile, display, mit_cookie):
+            DISPLAY_ATTEMPTS.inc(outcome = 'success')
             break
         else:
+            DISPLAY_ATTEMPTS.inc(outcome = 'failure')
+            release_display()
             display += 1
+    AUTH_SECONDS.observe(time.monotonic() - started)
     if display == 256:
+        AUTH_FAILURES.inc()
         print('%s: fail to find an unused display, stopped at 256' % sys.argv[0], file = sys.stderr)
-        return (None, mit_cookie)
+        return None
     
     # Export $DISPLAY
     setenv('DISPLAY', ':%i' % display)
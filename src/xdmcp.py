@@ -0,0 +1,458 @@
+# -*- python -*-
+'''
+exdm – The Extensible X Display Manager
+
+Copyright © 2015  Mattias Andrée (maandree@member.fsf.org)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import socket
+import struct
+
+from xauth import RUNDIR, PKGNAME
+
+
+XDMCP_PORT = 177
+'''
+:int  The UDP port XDMCP managers listen on
+'''
+
+XDMCP_MAX_SESSIONS = 1024
+'''
+:int  The maximum number of sessions, pending or managed, that are kept at the same time
+'''
+
+XDMCP_PENDING_TIMEOUT = 30
+'''
+:float  The number of seconds an accepted request is kept waiting for Manage
+'''
+
+XDMCP_MANAGE_RATE = 1
+'''
+:float  The number of Request and Manage packets per second a host may sustain,
+        retransmissions excluded
+'''
+
+XDMCP_MANAGE_BURST = 5
+'''
+:int  The number of Request and Manage packets a host may send in a burst
+'''
+
+MIT_MAGIC_COOKIE = b'MIT-MAGIC-COOKIE-1'
+
+(BROADCAST_QUERY, QUERY, INDIRECT_QUERY, FORWARD_QUERY, WILLING, UNWILLING, REQUEST,
+ ACCEPT, DECLINE, MANAGE, REFUSE, FAILED, KEEPALIVE, ALIVE) = range(1, 15)
+
+FAMILY_INTERNET, FAMILY_INTERNET6 = 0, 6
+
+
+
+class XDMCPReader:
+    '''
+    Reader for the fields of an XDMCP packet
+    
+    All reading methods throw `struct.error` if the packet is too short
+    '''
+    
+    def __init__(self, data : bytes, offset : int = 0):
+        '''
+        Constructor
+        
+        @param  data:bytes  The packet
+        @param  offset:int  The position of the first field
+        '''
+        self.data = data
+        self.offset = offset
+    
+    
+    def card(self, size : int) -> int:
+        '''
+        Read a CARD8, CARD16 or CARD32
+        
+        @param   size:int  The size of the field, in bytes
+        @return  :int      The value of the field
+        '''
+        fmt = {1 : '!B', 2 : '!H', 4 : '!I'}[size]
+        value = struct.unpack_from(fmt, self.data, self.offset)[0]
+        self.offset += size
+        return value
+    
+    
+    def array8(self) -> bytes:
+        '''
+        Read an ARRAY8
+        
+        @return  :bytes  The value of the field
+        '''
+        n = self.card(2)
+        if self.offset + n > len(self.data):
+            raise struct.error('truncated ARRAY8')
+        value = self.data[self.offset : self.offset + n]
+        self.offset += n
+        return value
+    
+    
+    def array16(self) -> list:
+        '''
+        Read an ARRAY16
+        
+        @return  :list<int>  The value of the field
+        '''
+        return [self.card(2) for _ in range(self.card(1))]
+    
+    
+    def array_of_array8(self) -> list:
+        '''
+        Read an ARRAYofARRAY8
+        
+        @return  :list<bytes>  The value of the field
+        '''
+        return [self.array8() for _ in range(self.card(1))]
+
+
+def pack_array8(value : bytes) -> bytes:
+    '''
+    Encode an ARRAY8
+    
+    @param   value:bytes  The value
+    @return  :bytes       The encoded value
+    '''
+    return struct.pack('!H', len(value)) + value
+
+
+def pack_packet(opcode : int, body : bytes) -> bytes:
+    '''
+    Add the XDMCP header to a packet
+    
+    @param   opcode:int  The opcode of the packet
+    @param   body:bytes  The fields of the packet
+    @return  :bytes      The packet
+    '''
+    return struct.pack('!HHH', 1, opcode, len(body)) + body
+
+
+class XDMCPSession:
+    '''
+    State of a remote display
+    
+    @variable  address:(str, int)  The address the display manager's packets came from
+    @variable  display:str?        The display name, `None` if the display is not managed yet
+    @variable  number:int          The display number
+    @variable  cookie:str          The MIT-MAGIC-COOKIE-1 cookie, 32 lowercase hexadecimal digits
+    @variable  host:str            The host address used in the display name
+    @variable  deadline:float?     When the session is dropped unless it becomes managed,
+                                   `None` once managed
+    @variable  heard:float         When the display last sent a packet for the session
+    '''
+    
+    __slots__ = ('address', 'display', 'number', 'cookie', 'host', 'deadline', 'heard')
+    
+    def __init__(self, address : tuple, number : int, host : str, cookie : str):
+        '''
+        Constructor
+        
+        @param  address:(str, int)  The address the request came from
+        @param  number:int          The display number
+        @param  host:str            The host address used in the display name
+        @param  cookie:str          The authorisation cookie
+        '''
+        self.address  = address
+        self.display  = None
+        self.number   = number
+        self.cookie   = cookie
+        self.host     = host
+        self.heard    = time.monotonic()
+        self.deadline = self.heard + XDMCP_PENDING_TIMEOUT
+
+
+def get_xdmcp_authentication_file(session_id : int) -> str:
+    '''
+    Get the pathname of the authentication file of a remote display
+    
+    @param   session_id:int  The session ID
+    @return  :str            The pathname of the authentication file
+    '''
+    return '%s/%s.xdmcp%08x.auth' % (RUNDIR, PKGNAME, session_id)
+
+
+class XDMCPManager:
+    '''
+    XDMCP manager for remote X terminals
+    
+    All requests are answered from one non-blocking UDP socket, call
+    `handle` when it is readable and `expire` now and then, at least
+    every `XDMCP_PENDING_TIMEOUT` seconds
+    
+    X servers only send KeepAlive when they have been idle, so managed
+    sessions cannot be expired on silence. Instead a managed session is
+    replaced when a new Request for the same display number comes from
+    the same source address, which happens when the X server has been
+    restarted. The connection address in the Request is chosen by the
+    sender, so it is never used to find the session to replace.
+    Managed sessions are never dropped to make room for new requests,
+    when the table is full the oldest pending request is dropped
+    
+    @variable  socket:socket                       The UDP socket
+    @variable  sessions:dict<int, XDMCPSession>    Session ID → session
+    @variable  on_manage:(int, XDMCPSession)→void  Function called when a display has
+                                                   become managed, its authentication
+                                                   file has been written
+    '''
+    
+    def __init__(self, on_manage : callable, port : int = XDMCP_PORT):
+        '''
+        Constructor
+        
+        @param  on_manage:(session_id:int, session:XDMCPSession)→void  Called when a display has become managed
+        @param  port:int                                                The UDP port to listen on
+        '''
+        try:
+            # Dual stack, so that one socket serves both IPv4 and IPv6
+            self.socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            try:
+                self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+                self.socket.bind(('::', port))
+            except OSError:
+                self.socket.close()
+                raise
+        except OSError:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind(('0.0.0.0', port))
+        self.socket.setblocking(False)
+        self.sessions = {}
+        self.on_manage = on_manage
+        self.__next_session_id = int.from_bytes(os.urandom(4), 'big') | 1
+        self.__buckets = {}
+    
+    
+    def fileno(self) -> int:
+        '''
+        Get the file descriptor to wait on
+        
+        @return  :int  The file descriptor of the socket
+        '''
+        return self.socket.fileno()
+    
+    
+    def handle(self):
+        '''
+        Answer all packets that have been received
+        '''
+        while True:
+            try:
+                (data, address) = self.socket.recvfrom(1 << 16)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # For example ICMP errors from earlier replies
+                continue
+            try:
+                (version, opcode, length) = struct.unpack_from('!HHH', data, 0)
+                if (not version == 1) or (not length == len(data) - 6):
+                    continue
+                reply = self.__dispatch(opcode, XDMCPReader(data, 6), address)
+            except struct.error:
+                continue
+            if reply is not None:
+                try:
+                    self.socket.sendto(reply, address)
+                except OSError:
+                    pass
+    
+    
+    def expire(self):
+        '''
+        Drop requests that were never followed by Manage
+        '''
+        now = time.monotonic()
+        for session_id in [s for s, x in self.sessions.items() if (x.deadline is not None) and (x.deadline < now)]:
+            del self.sessions[session_id]
+        self.__buckets = dict((h, b) for h, b in self.__buckets.items() if b[1] + XDMCP_MANAGE_BURST / XDMCP_MANAGE_RATE > now)
+    
+    
+    def __make_room(self, evict : bool) -> bool:
+        '''
+        Check that there is room for another session
+        
+        @param   evict:bool  Whether to drop the oldest pending session if the table is full
+        @return  :bool       Whether there is, or was made, room for another session
+        '''
+        if len(self.sessions) < XDMCP_MAX_SESSIONS:
+            return True
+        pending = [(x.heard, s) for s, x in self.sessions.items() if x.display is None]
+        if len(pending) == 0:
+            return False
+        if evict:
+            self.end_session(min(pending)[1])
+        return True
+    
+    
+    def end_session(self, session_id : int):
+        '''
+        Forget a session and remove its authentication file
+        
+        @param  session_id:int  The session ID
+        '''
+        if self.sessions.pop(session_id, None) is not None:
+            try:
+                os.unlink(get_xdmcp_authentication_file(session_id))
+            except OSError:
+                pass
+    
+    
+    def __dispatch(self, opcode : int, reader : XDMCPReader, address : tuple) -> bytes:
+        '''
+        Handle a packet
+        
+        @param   opcode:int          The opcode of the packet
+        @param   reader:XDMCPReader  The packet's fields
+        @param   address:(str, int)  The address of the sender
+        @return  :bytes?             The reply, `None` if none
+        '''
+        if opcode in (QUERY, BROADCAST_QUERY, INDIRECT_QUERY):
+            authentication_names = reader.array_of_array8()
+            if not self.__make_room(False):
+                if opcode == QUERY:
+                    return pack_packet(UNWILLING, pack_array8(os.uname().nodename.encode('utf-8')) +
+                                                  pack_array8(b'Too many sessions'))
+                return None
+            status = '%s, %i sessions' % (os.uname().sysname, len(self.sessions))
+            return pack_packet(WILLING, pack_array8(b'') + pack_array8(os.uname().nodename.encode('utf-8')) +
+                                        pack_array8(status.encode('utf-8')))
+        
+        elif opcode == REQUEST:
+            number = reader.card(2)
+            types = reader.array16()
+            addresses = reader.array_of_array8()
+            authentication_name = reader.array8()
+            reader.array8()
+            authorization_names = reader.array_of_array8()
+            def decline(status):
+                return pack_packet(DECLINE, pack_array8(status) + pack_array8(b'') + pack_array8(b''))
+            if not authentication_name == b'':
+                return decline(b'Authentication not supported')
+            if MIT_MAGIC_COOKIE not in authorization_names:
+                return decline(b'Only MIT-MAGIC-COOKIE-1 is supported')
+            host = None
+            for (family, raw) in zip(types, addresses):
+                if (family == FAMILY_INTERNET) and (len(raw) == 4):
+                    host = socket.inet_ntop(socket.AF_INET, raw)
+                elif (family == FAMILY_INTERNET6) and (len(raw) == 16):
+                    host = socket.inet_ntop(socket.AF_INET6, raw)
+                if host is not None:
+                    break
+            if host is None:
+                return decline(b'No usable connection address')
+            # A retransmitted request gets the same session
+            for session_id, session in self.sessions.items():
+                if (session.address == address) and (session.number == number) and (session.display is None):
+                    break
+            else:
+                if not self.__take_token(address[0]):
+                    return None
+                # Any other session for the display from the same source
+                # is stale, its X server has been restarted
+                for session_id, session in list(self.sessions.items()):
+                    if (session.address[0] == address[0]) and (session.number == number):
+                        self.end_session(session_id)
+                if not self.__make_room(True):
+                    return decline(b'Too many sessions')
+                from xauth import generate_mit_cookie
+                session_id = self.__next_session_id
+                self.__next_session_id = (self.__next_session_id + 2) & 0xFFFFFFFF
+                session = XDMCPSession(address, number, host, generate_mit_cookie())
+                self.sessions[session_id] = session
+            return pack_packet(ACCEPT, struct.pack('!I', session_id) + pack_array8(b'') + pack_array8(b'') +
+                                       pack_array8(MIT_MAGIC_COOKIE) + pack_array8(bytes.fromhex(session.cookie)))
+        
+        elif opcode == MANAGE:
+            session_id = reader.card(4)
+            number = reader.card(2)
+            session = self.sessions.get(session_id, None)
+            if (session is None) or (not session.address == address) or (not session.number == number):
+                return pack_packet(REFUSE, struct.pack('!I', session_id))
+            if session.display is not None:
+                # Retransmission, the display is already managed
+                return None
+            if not self.__take_token(address[0]):
+                return None
+            from xauth import add_authentication
+            if ':' in session.host:
+                session.display = '[%s]:%i' % (session.host, number)
+            else:
+                session.display = '%s:%i' % (session.host, number)
+            if not add_authentication(get_xdmcp_authentication_file(session_id), session.display, session.cookie):
+                self.end_session(session_id)
+                return pack_packet(FAILED, struct.pack('!I', session_id) + pack_array8(b'Cannot create authentication file'))
+            session.deadline = None
+            session.heard = time.monotonic()
+            self.on_manage(session_id, session)
+            return None
+        
+        elif opcode == KEEPALIVE:
+            number = reader.card(2)
+            session_id = reader.card(4)
+            session = self.sessions.get(session_id, None)
+            running = (session is not None) and (session.display is not None) and (session.number == number)
+            if running:
+                session.heard = time.monotonic()
+            return pack_packet(ALIVE, struct.pack('!BI', 1 if running else 0, session_id if running else 0))
+        
+        return None
+    
+    
+    def __take_token(self, host : str) -> bool:
+        '''
+        Rate limit Request and Manage packets per host with a token bucket
+        
+        @param   host:str  The address of the host
+        @return  :bool     Whether the request may proceed
+        '''
+        now = time.monotonic()
+        (tokens, then) = self.__buckets.get(host, (XDMCP_MANAGE_BURST, now))
+        tokens = min(XDMCP_MANAGE_BURST, tokens + (now - then) * XDMCP_MANAGE_RATE)
+        if tokens < 1:
+            self.__buckets[host] = (tokens, now)
+            return False
+        self.__buckets[host] = (tokens - 1, now)
+        return True
+
+
+def serve_xdmcp(port : int = XDMCP_PORT):
+    '''
+    Act as an XDMCP manager until the display manager is terminated
+    
+    @param  port:int  The UDP port to listen on
+    '''
+    import select, sys
+    def on_manage(session_id, session):
+        print('%s: managing remote display %s' % (sys.argv[0], session.display), file = sys.stderr)
+    try:
+        manager = XDMCPManager(on_manage, port)
+    except OSError as err:
+        print('%s: cannot listen for XDMCP: %s' % (sys.argv[0], err.strerror), file = sys.stderr)
+        sys.exit(1)
+    poller = select.poll()
+    poller.register(manager.fileno(), select.POLLIN)
+    try:
+        while True:
+            poller.poll(XDMCP_PENDING_TIMEOUT * 1000 / 2)
+            manager.handle()
+            manager.expire()
+    finally:
+        for session_id in list(manager.sessions.keys()):
+            manager.end_session(session_id)
@@ -19,6 +19,23 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 
+DEFAULT_XSERVER_STOP_TIMEOUT = 5 # @@
+'''
+:float  The number of seconds the X server is given to terminate before it is killed,
+        unless another value is configured
+'''
+
+XSERVER_STOP_TIMEOUT = DEFAULT_XSERVER_STOP_TIMEOUT
+'''
+:float  The number of seconds the X server is given to terminate before it is killed
+'''
+
+XSERVER_READY_TIMEOUT = 30 # @@
+'''
+:float  The number of seconds the X server is given to become ready
+'''
+
+
 def get_xserver_arguments(cmdline) -> list:
     '''
     Get the arguments that are executed to start the X server
@@ -29,9 +46,13 @@ def get_xserver_arguments(cmdline) -> list:
     @return  :list<str>         The arguments that are executed to start the X server
     '''
     import os
+    from config import get_configuration
     server_args = ['X',     os.environ['DISPLAY'],
                    'vt%s' % os.environ['XDG_VTNR'],
                    '-auth', os.environ['XAUTHORITY']]
+    conf = get_configuration()
+    if conf is not None:
+        server_args += conf.x_arguments
     server_args += [a for a in cmdline.opts['--x-argument'] if a is not None]
     return server_args
 
@@ -46,24 +67,155 @@ def ignore_signals_for_xserver():
     signal.signal(signal.SIGUSR1, signal.SIG_IGN)
 
 
+__xserver_pid = None
+__xserver_started = None
 def fork_exec_xserver(cmdline) -> int:
     '''
     Fork–exec the X server
     
+    SIGUSR1 and SIGCHLD are left blocked in the calling thread for
+    `wait_for_server`, other threads must keep them blocked too,
+    or the kernel may deliver them there, where they are lost
+    
     @param   cmdline:ArgParser  The command line parser
     @return  :int               The process Id of the X server
     '''
-    import os, sys
+    import os, sys, time, signal
+    from metrics import XSERVER_START_SECONDS
+    global __xserver_pid, __xserver_started
     server_args = get_xserver_arguments(cmdline)
+    started = time.monotonic()
+    sigmask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGUSR1, signal.SIGCHLD])
     server_pid = os.fork()
     if server_pid == 0:
         ignore_signals_for_xserver()
+        signal.pthread_sigmask(signal.SIG_SETMASK, sigmask)
         os.setpgid(0, os.getpid())
         try:
             os.execvp(server_args[0], server_args)
         except:
             pass
         print('%s: failed to start X server' % sys.argv[0], file = sys.stderr)
-        sys.exit(1)
+        sys.stderr.flush()
+        # Do not let the child run the display manager's clean up
+        os._exit(1)
+    try:
+        # Also set in the parent so that the process group
+        # exists before we may have to signal it
+        os.setpgid(server_pid, server_pid)
+    except:
+        pass
+    __xserver_pid = server_pid
+    __xserver_started = started
+    XSERVER_START_SECONDS.observe(time.monotonic() - started)
     return server_pid
 
+
+def mark_server_ready():
+    '''
+    Record that the X server has signalled that it is ready to accept connections
+    '''
+    import time
+    from metrics import XSERVER_READY_SECONDS
+    global __xserver_started
+    if __xserver_started is not None:
+        XSERVER_READY_SECONDS.observe(time.monotonic() - __xserver_started)
+        __xserver_started = None
+
+
+def wait_for_server(server_pid : int, timeout : float = None) -> bool:
+    '''
+    Wait for the X server to signal that it is ready to accept connections
+    
+    The X server must have been started with `fork_exec_xserver`,
+    it is not reaped if it dies. SIGUSR1 and SIGCHLD are unblocked
+    before this function returns
+    
+    @param   server_pid:int  The process ID of the X server
+    @param   timeout:float?  The maximum number of seconds to wait, `None` for `XSERVER_READY_TIMEOUT`
+    @return  :bool           Whether the X server became ready, `False` if it died or did not
+                             become ready in time
+    '''
+    import os, time, signal
+    if timeout is None:
+        timeout = XSERVER_READY_TIMEOUT
+    deadline = time.monotonic() + timeout
+    try:
+        if __xserver_started is None:
+            # SIGUSR1 was already handled, for example before the signals were blocked
+            return True
+        if os.waitid(os.P_PID, server_pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+            # Died before we started waiting, its SIGCHLD may have gone elsewhere
+            return False
+        while True:
+            info = signal.sigtimedwait([signal.SIGUSR1, signal.SIGCHLD], max(0, deadline - time.monotonic()))
+            if info is None:
+                return False
+            if info.si_signo == signal.SIGUSR1:
+                mark_server_ready()
+                return True
+            # SIGCHLD may be from another child, do not reap so stop_server gets the exit status
+            if os.waitid(os.P_PID, server_pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+                return False
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGUSR1, signal.SIGCHLD])
+
+
+def stop_server(server_pid : int = None, timeout : float = None) -> int:
+    '''
+    Terminate the X server and its process group, and reap it
+    
+    The process group is sent SIGTERM, if the X server has not died
+    within `timeout` seconds, SIGKILL is sent to the process group.
+    Any other child process that has died is also reaped
+    
+    @param   server_pid:int?  The process ID of the X server, `None` for the last started X server
+    @param   timeout:float?   The number of seconds to wait before SIGKILL is sent,
+                              `None` for `XSERVER_STOP_TIMEOUT`
+    @return  :int?            The exit status of the X server, `None` if it was not running
+    '''
+    import os, signal, sys
+    from util import pidfd_wait, reap_children
+    from metrics import XSERVER_CRASHES
+    global __xserver_pid
+    if timeout is None:
+        timeout = XSERVER_STOP_TIMEOUT
+    if server_pid is None:
+        server_pid = __xserver_pid
+    if server_pid is None:
+        return None
+    if server_pid == __xserver_pid:
+        __xserver_pid = None
+    try:
+        (reaped, status) = os.waitpid(server_pid, os.WNOHANG)
+    except ChildProcessError:
+        (reaped, status) = (0, None)
+    if reaped == server_pid:
+        # The X server died before we asked it to, but
+        # it may have left something in the process group
+        XSERVER_CRASHES.inc()
+        try:
+            os.killpg(server_pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        reap_children()
+        return status
+    try:
+        os.killpg(server_pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    if not pidfd_wait(server_pid, timeout):
+        print('%s: X server did not terminate, killing it' % sys.argv[0], file = sys.stderr)
+    # Kill the X server if it is still running, and
+    # anything it has left behind in the process group
+    try:
+        os.killpg(server_pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    try:
+        status = os.waitpid(server_pid, 0)[1]
+    except ChildProcessError:
+        status = None
+    reap_children()
+    return status
+